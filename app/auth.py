@@ -1,8 +1,61 @@
+from typing import Annotated
 from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import Depends, HTTPException
+
+from app.services.auth_cache import user_owns_collection
+
+# Parsed once at import instead of on every request
+_CURRENT_USER_ID = ObjectId("6849b5a2922ebe923169e328")
+
+# Annotated dependency aliases for route signatures. FastAPI resolves each dependency
+# at most once per request and shares the result between all parameters that use it.
 
 async def get_current_user_id() -> ObjectId:
     """
     Gets the current user's ID. 
     Replace with your actual auth logic (e.g., decoding a JWT token).
+    Kept async: FastAPI runs sync dependencies in its threadpool, which costs more than a coroutine.
     """
-    return ObjectId("6849b5a2922ebe923169e328")
+    return _CURRENT_USER_ID
+
+UserId = Annotated[ObjectId, Depends(get_current_user_id)]
+
+def _parse_object_id(value: str, detail: str) -> ObjectId:
+    """Parses a hex ObjectId in one pass (no separate is_valid check), raising 400 if malformed."""
+    try:
+        return ObjectId(value)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail=detail)
+
+async def parsed_collection_id(collection_id: str) -> ObjectId:
+    """Dependency that validates and parses the collection ID path parameter once per request."""
+    return _parse_object_id(collection_id, "Invalid collection ID format.")
+
+CollectionId = Annotated[ObjectId, Depends(parsed_collection_id)]
+
+async def parsed_source_id(source_id: str) -> ObjectId:
+    """Dependency that validates and parses the source ID path parameter once per request."""
+    return _parse_object_id(source_id, "Invalid ID format.")
+
+SourceId = Annotated[ObjectId, Depends(parsed_source_id)]
+
+async def parsed_reinforcement_id(reinforcement_id: str) -> ObjectId:
+    """Dependency that validates and parses the reinforcement item ID path parameter once per request."""
+    return _parse_object_id(reinforcement_id, "Invalid ID format.")
+
+ReinforcementId = Annotated[ObjectId, Depends(parsed_reinforcement_id)]
+
+async def parsed_ids(cid: CollectionId, sid: SourceId) -> tuple[ObjectId, ObjectId]:
+    """Dependency returning the parsed (collection ID, source ID) pair."""
+    return cid, sid
+
+SourceIds = Annotated[tuple[ObjectId, ObjectId], Depends(parsed_ids)]
+
+async def verify_collection_access(cid: CollectionId, user_id: UserId) -> ObjectId:
+    """Dependency that 404s unless the current user owns the collection; returns its parsed ID."""
+    if not await user_owns_collection(cid, user_id):
+        raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
+    return cid
+
+OwnedCollectionId = Annotated[ObjectId, Depends(verify_collection_access)]
@@ -1,68 +1,435 @@
+import os
 import time
-from typing import Any
+import asyncio
+import datetime
+from array import array
+from collections import deque
 
-# _chat_sessions stores: { "session_id": {"user_id": str, "history": list, "last_access": float} }
-_chat_sessions: dict[str, dict[str, Any]] = {}
-# _user_to_session_map stores: { "user_id": "current_session_id" }
-_user_to_session_map: dict[str, str] = {}
+import numpy as np
+import orjson
+from bson import ObjectId
+from cachetools import TTLCache
+from pymongo import UpdateOne
+from redis.asyncio import Redis
+
+from app.database import chats_db, contents_db
+
+# ─── Environment Configuration ────────────────────────────────────────────────
+REDIS_URL = os.getenv("REDIS_URL")
 
 SESSION_TTL_SECONDS = 6 * 60 * 60  # 6 hours
+SESSION_TTL_NS = SESSION_TTL_SECONDS * 1_000_000_000
+SWEEP_INTERVAL_SECONDS = 15 * 60  # 15 minutes
 MAX_HISTORY_PAIRS = 5  # 5 pairs of user/assistant messages (10 total)
+SESSION_POOL_MAX = 1024  # Purged history deques kept for reuse
+RESPONSE_TTL_SECONDS = 60  # Lifetime of cached GET response bodies
+CHAT_FLUSH_INTERVAL_SECONDS = 0.05  # Max time a chat write waits in the queue
+CHAT_FLUSH_MAX_MESSAGES = 32  # Flush early once this many messages are pending
+MAX_STORED_CHAT_MESSAGES = 200  # Older collection chat messages are dropped from the session document
+COLLECTION_TEXT_TTL_SECONDS = 60 * 60  # 1 hour
+COLLECTION_TEXT_MAX_CHARS = 256 * 1024 * 1024  # Budget of the local collection text cache
+CHECKSUMS_KEY = "checksums"
+CHECKSUM_LOAD_BATCH = 10_000  # Checksums per cursor batch and per SADD when seeding the set
+
+# ─── Client Initialization ────────────────────────────────────────────────────
+# The Redis client is created in main.lifespan via init_cache(). Without REDIS_URL
+# the cache falls back to the in-process store below, which limits the app to a
+# single worker.
+redis_client: Redis | None = None
+cache_mode = "local"
+_session_script = None  # Registered on redis_client by init_cache(); see _SESSION_LUA
+
+# The local session store is a struct-of-arrays: session i is described by
+# _sids[i], _owners[i], _histories[i] and _last_access_ns[i]. Keeping the timestamps in
+# one contiguous int64 array lets the sweeper scan them in a single vectorized compare.
+# last_access is a time.monotonic_ns() tick, so TTL math is immune to wall-clock jumps.
+_sids: list[str] = []
+_owners: list[str] = []
+_histories: list[deque] = []
+_last_access_ns = array("q")
+# _sid_to_idx stores: { "session_id": index into the arrays above }
+_sid_to_idx: dict[str, int] = {}
+# _user_to_session_map stores: { "user_id": "current_session_id" }
+_user_to_session_map: dict[str, str] = {}
+# Guards read-modify-write sequences on the store above
+_cache_lock = asyncio.Lock()
+# Free-list of purged history deques, cleared and reused to cut allocator churn
+_history_pool: list[deque] = []
+
+
+def _history_key(session_id: str) -> str:
+    return f"sess:{session_id}"
+
+def _owner_key(session_id: str) -> str:
+    return f"sess_owner:{session_id}"
+
+def _user_key(user_id: str) -> str:
+    return f"u2s:{user_id}"
+
+
+async def init_cache():
+    """Connects to Redis if REDIS_URL is configured, otherwise keeps the local cache."""
+    global redis_client, cache_mode, _session_script
+    if not REDIS_URL:
+        print("⚠️  Cache: REDIS_URL not set. Using in-process session cache.")
+        return
+    try:
+        client = Redis.from_url(REDIS_URL, decode_responses=True)
+        await client.ping()
+        redis_client = client
+        _session_script = client.register_script(_SESSION_LUA)
+        cache_mode = "redis"
+        print("✅ Cache: Connected to Redis.")
+    except Exception as e:
+        print(f"❌ Cache: Failed to connect to Redis. Falling back to local. Error: {e}")
+
+async def close_cache():
+    """Closes the Redis connection pool, if one was opened."""
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+def _remove_at(idx: int):
+    """Removes session idx by moving the last session into its slot (O(1), order not kept)."""
+    history = _histories[idx]
+    last = len(_sids) - 1
+    if idx != last:
+        _sids[idx] = _sids[last]
+        _owners[idx] = _owners[last]
+        _histories[idx] = _histories[last]
+        _last_access_ns[idx] = _last_access_ns[last]
+        _sid_to_idx[_sids[idx]] = idx
+    _sids.pop()
+    _owners.pop()
+    _histories.pop()
+    _last_access_ns.pop()
+
+    if len(_history_pool) < SESSION_POOL_MAX:
+        history.clear()
+        _history_pool.append(history)
 
 def _purge_session(session_id: str):
     """Safely removes a session from the cache."""
-    if session_id in _chat_sessions:
-        del _chat_sessions[session_id]
+    idx = _sid_to_idx.pop(session_id, None)
+    if idx is not None:
+        _remove_at(idx)
 
-def get_or_create_session_history(session_id: str, user_id: str) -> list:
+def _add_session(session_id: str, user_id: str, now: int):
+    """Appends a new session, reusing a pooled history deque when one is available."""
+    _sid_to_idx[session_id] = len(_sids)
+    _sids.append(session_id)
+    _owners.append(user_id)
+    _histories.append(_history_pool.pop() if _history_pool else deque(maxlen=MAX_HISTORY_PAIRS * 2))
+    _last_access_ns.append(now)
+
+async def get_or_create_session_history(session_id: str, user_id: str) -> list:
     """
     Handles the core session logic.
     - Purges any previous session associated with the user.
     - Creates a new session if the provided session_id is new.
     - Returns the history for the current valid session.
     """
-    # 1. Check if this user has an existing session and if it's different from the new one.
-    old_session_id = _user_to_session_map.get(user_id)
-    if old_session_id and old_session_id != session_id:
-        _purge_session(old_session_id)
-
-    # 2. Update the user-to-session map to the new session_id
-    _user_to_session_map[user_id] = session_id
-    
-    # 3. Check if the session for the new ID already exists
-    if session_id in _chat_sessions:
-        # Session exists, check for expiration and ownership
-        session = _chat_sessions[session_id]
-        if time.time() - session["last_access"] > SESSION_TTL_SECONDS:
-            # Expired, treat as a new session
-            _purge_session(session_id)
-            # Fall through to create a new session below
-        elif session["user_id"] != user_id:
-            # Session ID collision with another user (highly unlikely with UUIDs, but good practice)
-            # Treat as a new session for the current user
-            _purge_session(session_id)
-            # Fall through
-        else:
-            # Valid, existing session for this user
-            session["last_access"] = time.time()
-            return session["history"]
-
-    # 4. If we've reached here, we need to create a new session entry
-    _chat_sessions[session_id] = {
-        "user_id": user_id,
-        "history": [],
-        "last_access": time.time()
-    }
-    return _chat_sessions[session_id]["history"]
-
-def add_messages_to_history(session_id: str, messages: list):
+    if cache_mode == "redis":
+        return await _redis_get_or_create_session_history(session_id, user_id)
+
+    now = time.monotonic_ns()
+    async with _cache_lock:
+        # 1. Check if this user has an existing session and if it's different from the new one.
+        old_session_id = _user_to_session_map.get(user_id)
+        if old_session_id and old_session_id != session_id:
+            _purge_session(old_session_id)
+
+        # 2. Update the user-to-session map to the new session_id
+        _user_to_session_map[user_id] = session_id
+
+        # 3. Check if the session for the new ID already exists
+        idx = _sid_to_idx.get(session_id)
+        if idx is not None:
+            # Session exists, check for expiration and ownership
+            if now - _last_access_ns[idx] > SESSION_TTL_NS:
+                # Expired, treat as a new session
+                _purge_session(session_id)
+                # Fall through to create a new session below
+            elif _owners[idx] != user_id:
+                # Session ID collision with another user (highly unlikely with UUIDs, but good practice)
+                # Treat as a new session for the current user
+                _purge_session(session_id)
+                # Fall through
+            else:
+                # Valid, existing session for this user
+                _last_access_ns[idx] = now
+                # Return a snapshot: the deque may be recycled to another session once purged
+                return list(_histories[idx])
+
+        # 4. If we've reached here, we need to create a new session entry
+        _add_session(session_id, user_id, now)
+        return []
+
+async def add_messages_to_history(session_id: str, messages: list):
     """Adds new messages to a session's history and trims it."""
-    if session_id in _chat_sessions:
-        history = _chat_sessions[session_id]["history"]
-        history.extend(messages)
-        
-        max_len = MAX_HISTORY_PAIRS * 2
-        if len(history) > max_len:
-            _chat_sessions[session_id]["history"] = history[-max_len:]
-        
-        _chat_sessions[session_id]["last_access"] = time.time()
+    if cache_mode == "redis":
+        await _redis_add_messages_to_history(session_id, messages)
+        return
+
+    async with _cache_lock:
+        idx = _sid_to_idx.get(session_id)
+        if idx is not None:
+            # The deque's maxlen drops the oldest messages automatically
+            _histories[idx].extend(messages)
+            _last_access_ns[idx] = time.monotonic_ns()
+
+
+async def run_session_sweeper():
+    """
+    Periodically evicts expired sessions from the in-process cache so abandoned
+    sessions don't accumulate. Redis expires its keys natively, so this is a no-op there.
+    """
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+        if cache_mode == "redis":
+            continue
+
+        # One bad pass must not end the task, or local sessions would never expire again
+        try:
+            async with _cache_lock:
+                if _sids:
+                    cutoff = time.monotonic_ns() - SESSION_TTL_NS
+                    expired = np.flatnonzero(np.frombuffer(_last_access_ns, dtype=np.int64) < cutoff)
+                    # Remove from the highest index down so swap-removal never moves an unvisited expired slot
+                    for idx in reversed(expired.tolist()):
+                        del _sid_to_idx[_sids[idx]]
+                        _remove_at(idx)
+
+                # Drop user mappings that point at sessions which no longer exist
+                for user_id, session_id in list(_user_to_session_map.items()):
+                    if session_id not in _sid_to_idx:
+                        del _user_to_session_map[user_id]
+        except Exception as e:
+            print(f"ERROR: Session sweep failed: {e}")
+
+
+# ─── Redis Backend ────────────────────────────────────────────────────────────
+# Keys expire after SESSION_TTL_SECONDS of inactivity, so Redis does the eviction:
+#   sess:{session_id}        LIST of JSON-encoded messages (capped at MAX_HISTORY_PAIRS*2)
+#   sess_owner:{session_id}  user_id owning the session
+#   u2s:{user_id}            the user's current session_id
+
+# Resolves a session in one round-trip, atomically, so concurrent requests can't interleave
+# between reading the previous session and claiming the new one.
+# KEYS: u2s:{user_id}, sess_owner:{session_id}, sess:{session_id}
+# ARGV: session_id, user_id, ttl_seconds, history key prefix, owner key prefix
+_SESSION_LUA = """
+local old = redis.call('GET', KEYS[1])
+-- 1. Purge the user's previous session if they switched to a new one.
+if old and old ~= ARGV[1] then
+    redis.call('DEL', ARGV[4] .. old, ARGV[5] .. old)
+end
+-- 2. A missing owner means the session is new or expired; a different owner
+--    is an ID collision. Either way, start from an empty history.
+if redis.call('GET', KEYS[2]) ~= ARGV[2] then
+    redis.call('DEL', KEYS[3])
+end
+-- 3. Claim the session, refresh all TTLs and return the history.
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+return redis.call('LRANGE', KEYS[3], 0, -1)
+"""
+
+async def _redis_get_or_create_session_history(session_id: str, user_id: str) -> list:
+    raw_messages = await _session_script(
+        keys=[_user_key(user_id), _owner_key(session_id), _history_key(session_id)],
+        args=[session_id, user_id, SESSION_TTL_SECONDS, _history_key(""), _owner_key("")]
+    )
+    return [orjson.loads(raw) for raw in raw_messages]
+
+async def _redis_add_messages_to_history(session_id: str, messages: list):
+    if not messages:
+        return
+    history_key = _history_key(session_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(history_key, *(orjson.dumps(msg) for msg in messages))
+        pipe.ltrim(history_key, -MAX_HISTORY_PAIRS * 2, -1)
+        pipe.expire(history_key, SESSION_TTL_SECONDS)
+        pipe.expire(_owner_key(session_id), SESSION_TTL_SECONDS)
+        await pipe.execute()
+
+
+# ─── Response Cache ───────────────────────────────────────────────────────────
+# Serialized JSON bodies of read-heavy GET endpoints, stored under "resp:{key}" in Redis
+# or in a local TTLCache. Routes that modify the underlying data must invalidate the keys.
+_local_responses: TTLCache = TTLCache(maxsize=4096, ttl=RESPONSE_TTL_SECONDS)
+
+async def get_cached_response(key: str) -> str | bytes | None:
+    """Returns a cached response body, or None on a miss."""
+    if cache_mode == "redis":
+        return await redis_client.get(f"resp:{key}")
+    return _local_responses.get(key)
+
+async def set_cached_response(key: str, body: bytes):
+    """Caches a response body for RESPONSE_TTL_SECONDS."""
+    if cache_mode == "redis":
+        await redis_client.set(f"resp:{key}", body, ex=RESPONSE_TTL_SECONDS)
+    else:
+        _local_responses[key] = body
+
+async def invalidate_responses(*keys: str):
+    """Drops cached response bodies so the next GET reads fresh data."""
+    if cache_mode == "redis":
+        await redis_client.delete(*(f"resp:{key}" for key in keys))
+    else:
+        for key in keys:
+            _local_responses.pop(key, None)
+
+
+# ─── Collection Text Cache ────────────────────────────────────────────────────
+# Concatenated chunk text of a collection, which every generation endpoint feeds to the LLM.
+# Callers put the collection's content version in the key, so entries never go stale;
+# stored under "text:{key}" in Redis or in a local TTLCache bounded by total characters.
+_local_texts: TTLCache = TTLCache(maxsize=COLLECTION_TEXT_MAX_CHARS, ttl=COLLECTION_TEXT_TTL_SECONDS, getsizeof=len)
+
+async def get_collection_text(key: str) -> str | None:
+    """Returns a cached collection text, or None on a miss."""
+    if cache_mode == "redis":
+        return await redis_client.get(f"text:{key}")
+    return _local_texts.get(key)
+
+async def set_collection_text(key: str, text: str):
+    """Caches a collection text for COLLECTION_TEXT_TTL_SECONDS."""
+    if cache_mode == "redis":
+        await redis_client.set(f"text:{key}", text, ex=COLLECTION_TEXT_TTL_SECONDS)
+    elif len(text) <= COLLECTION_TEXT_MAX_CHARS:
+        _local_texts[key] = text
+
+
+# ─── Known Checksums ──────────────────────────────────────────────────────────
+# Every checksum stored in contents, kept as the Redis set "checksums" or a local set, so an
+# upload of never-seen files can skip the Mongo duplicate lookup. Only a miss is trusted: a hit
+# (or a set that hasn't been loaded) falls back to Mongo, so checksums are never removed when
+# sources are deleted. The Redis set always holds a "" member, so an evicted set reads as unloaded.
+_known_checksums: set[str] | None = None
+
+async def load_known_checksums():
+    """
+    Seeds the checksum set from Mongo, unless Redis already holds it. Called at startup.
+    The contents are streamed from a cursor (distinct fails past the 16 MB BSON limit), and a
+    failed load leaves the set unloaded, which only means every upload checks Mongo.
+    """
+    global _known_checksums
+    loading_key = f"{CHECKSUMS_KEY}:loading:{os.getpid()}"
+    try:
+        if cache_mode == "redis" and await redis_client.sismember(CHECKSUMS_KEY, ""):
+            return
+        cursor = contents_db.find({}, {"checksum": 1, "_id": 0}, batch_size=CHECKSUM_LOAD_BATCH)
+        if cache_mode == "redis":
+            # Build aside and merge in one step, so other workers never trust a half-loaded set
+            # and checksums added meanwhile by uploads are kept.
+            batch = [""]
+            async for doc in cursor:
+                if doc.get("checksum"):
+                    batch.append(doc["checksum"])
+                if len(batch) >= CHECKSUM_LOAD_BATCH:
+                    await redis_client.sadd(loading_key, *batch)
+                    batch = []
+            if batch:
+                await redis_client.sadd(loading_key, *batch)
+            await redis_client.sunionstore(CHECKSUMS_KEY, [CHECKSUMS_KEY, loading_key])
+            await redis_client.delete(loading_key)
+        else:
+            _known_checksums = {doc["checksum"] async for doc in cursor if doc.get("checksum")}
+    except Exception as e:
+        print(f"WARNING: Could not load known checksums; uploads will always check Mongo. Error: {e}")
+        if cache_mode == "redis":
+            try:
+                await redis_client.delete(loading_key)
+            except Exception:
+                pass
+
+async def any_checksum_known(checksums: list[str]) -> bool:
+    """False only if none of the checksums has ever been stored; True means check Mongo."""
+    if cache_mode == "redis":
+        loaded, *hits = await redis_client.smismember(CHECKSUMS_KEY, ["", *checksums])
+        return not loaded or any(hits)
+    return _known_checksums is None or any(checksum in _known_checksums for checksum in checksums)
+
+async def add_known_checksums(*checksums: str):
+    """Records newly stored checksums; call it before the content document is inserted."""
+    if cache_mode == "redis":
+        await redis_client.sadd(CHECKSUMS_KEY, *checksums)
+    elif _known_checksums is not None:
+        _known_checksums.update(checksums)
+
+
+# ─── Chat History Write-Behind ────────────────────────────────────────────────
+# Collection chat turns are appended to Mongo by a single background writer, which
+# coalesces everything queued within CHAT_FLUSH_INTERVAL_SECONDS into one bulk_write.
+# Items are (collection_id, user_id, messages, queued_at); None asks the writer to stop.
+_pending_chat_writes: asyncio.Queue[tuple[ObjectId, ObjectId, list, datetime.datetime] | None] = asyncio.Queue()
+
+def queue_chat_messages(collection_id: ObjectId, user_id: ObjectId, messages: list):
+    """Queues messages to be appended to the user's ChatSession for this collection."""
+    _pending_chat_writes.put_nowait((collection_id, user_id, messages, datetime.datetime.now(datetime.timezone.utc)))
+
+async def _flush_chat_writes(batch: list):
+    """Writes a batch of queued chat turns, merging turns for the same session into one op."""
+    # Merging per session keeps each session's messages in order even with ordered=False.
+    sessions: dict[tuple[ObjectId, ObjectId], list] = {}
+    for collection_id, user_id, messages, queued_at in batch:
+        entry = sessions.setdefault((collection_id, user_id), [[], queued_at, queued_at])
+        entry[0].extend(messages)
+        entry[2] = queued_at
+
+    ops = [
+        UpdateOne(
+            {"collectionId": collection_id, "userId": user_id},
+            # $slice keeps the session document bounded instead of growing with every turn
+            {"$push": {"messages": {"$each": messages, "$slice": -MAX_STORED_CHAT_MESSAGES}},
+             "$set": {"updatedAt": last_at},
+             "$setOnInsert": {"status": "active", "createdAt": first_at}},
+            upsert=True
+        )
+        for (collection_id, user_id), (messages, first_at, last_at) in sessions.items()
+    ]
+    try:
+        await chats_db.bulk_write(ops, ordered=False)
+    except Exception as e:
+        print(f"ERROR: Failed to write {len(ops)} chat session update(s): {e}")
+
+async def run_chat_writer():
+    """
+    Drains the chat write queue until stop_chat_writer() is called. A batch is flushed
+    CHAT_FLUSH_INTERVAL_SECONDS after its first item or once it holds
+    CHAT_FLUSH_MAX_MESSAGES messages, whichever comes first.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _pending_chat_writes.get()
+        if item is None:
+            return
+        batch = [item]
+        pending = len(item[2])
+        deadline = loop.time() + CHAT_FLUSH_INTERVAL_SECONDS
+        stopping = False
+        while pending < CHAT_FLUSH_MAX_MESSAGES:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_pending_chat_writes.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+            pending += len(item[2])
+
+        await _flush_chat_writes(batch)
+        if stopping:
+            return
+
+async def stop_chat_writer(writer: asyncio.Task):
+    """Flushes every queued chat write, then waits for the writer to exit."""
+    # The queue is FIFO, so everything queued before the sentinel is written first.
+    _pending_chat_writes.put_nowait(None)
+    await writer
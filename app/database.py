@@ -5,23 +5,44 @@ from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from app.utils import CachedQueryEmbeddings
+
 load_dotenv()
 
 # --- Centralized Setup & Configuration ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MONGO_ENDPOINT = os.getenv("MONGO_ENDPOINT")
 QDRANT_ENDPOINT = os.getenv("QDRANT_ENDPOINT")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE") or 100)
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE") or 10)
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS") or 300_000)  # 5 minutes
 
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY not found in environment variables.")
 
 # Initialize clients once
 llm = ChatOpenAI(model="gpt-4o")
-embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-qdrant_client = QdrantClient(url=QDRANT_ENDPOINT, prefer_grpc=True)
-
-# Use the native PyMongo async client, not motor
-mongo_client = AsyncMongoClient(MONGO_ENDPOINT)
+embeddings = CachedQueryEmbeddings(OpenAIEmbeddings(model="text-embedding-3-large"))
+qdrant_client = QdrantClient(
+    url=QDRANT_ENDPOINT,
+    prefer_grpc=True,
+    timeout=5,
+    grpc_options={"grpc.max_receive_message_length": 32 << 20}  # 32 MiB, for large scrolls
+)
+
+# Use the native PyMongo async client, not motor.
+# Keep a warm pool of connections and compress traffic to cut reconnects and wire bytes.
+# Uploads now run their Mongo work concurrently, so the pool is sized per deployment.
+mongo_client = AsyncMongoClient(
+    MONGO_ENDPOINT,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    compressors="zstd,zlib",
+    retryReads=True,
+    retryWrites=True,
+    serverSelectionTimeoutMS=2000
+)
 openai_client = OpenAI(api_key=OPENAI_API_KEY) # For audio transcription
 
 # Get the async database object
@@ -38,3 +59,4 @@ chats_db = db["ChatSession"]
 reinforcement_db = db["ReinforcementItem"]
 document_analysis_db = db["DocumentAnalysis"]
 users_db = db["User"]
+pending_file_deletions_db = db["PendingFileDeletion"]
@@ -0,0 +1,28 @@
+import sys
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# Loggers under "app" only put records on a queue; a listener thread does the blocking writes
+# to stdout, off the event loop. Records logged before the listener starts wait in the queue.
+_queue: queue.SimpleQueue = queue.SimpleQueue()
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+_listener = QueueListener(_queue, _handler)
+
+_app_logger = logging.getLogger("app")
+_app_logger.setLevel(logging.INFO)
+_app_logger.addHandler(QueueHandler(_queue))
+_app_logger.propagate = False
+
+def get_logger(name: str) -> logging.Logger:
+    """Returns a queue-backed logger; pass the module's __name__."""
+    return logging.getLogger(name)
+
+def start():
+    """Starts the listener thread that writes queued records."""
+    _listener.start()
+
+def stop():
+    """Writes every queued record, then stops the listener thread."""
+    _listener.stop()
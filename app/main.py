@@ -1,13 +1,17 @@
 import os
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from app.routers import collections, reinforcement, chat, analysis, document_chat, user
 from app.database import db
+from app import cache, log
 from app.migrations import run_migrations
+from app.services import collection_service, storage_service
+from app.utils import MongoORJSONResponse
 
 # ─── Environment Configuration ────────────────────────────────────────────────
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:4173")
@@ -15,15 +19,42 @@ ORIGINS     = [url.strip() for url in FRONTEND_URL.split(",") if url.strip()]
 
 # Directory where your Vite build lives
 SPA_DIST    = os.getenv("SPA_DIST", "app/static/dist")
-INDEX_FILE  = os.path.join(SPA_DIST, "index.html")
 ASSETS_DIR  = os.path.join(SPA_DIST, "assets")
 
+class SPAStaticFiles(StaticFiles):
+    """
+    StaticFiles that falls back to index.html for unknown paths,
+    so React Router can handle client-side routes.
+    """
+    async def get_response(self, path: str, scope):
+        try:
+            return await super().get_response(path, scope)
+        except StarletteHTTPException as e:
+            if e.status_code != 404:
+                raise
+            return await super().get_response("index.html", scope)
+
 # ─── Lifespan Event Handler ───────────────────────────────────────────────────
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("FastAPI application is starting up…")
+    log.start()
     await run_migrations(db)
-    yield
+    await cache.init_cache()
+    await cache.load_known_checksums()
+    sweeper = asyncio.create_task(cache.run_session_sweeper())
+    chat_writer = asyncio.create_task(cache.run_chat_writer())
+    storage_collector = asyncio.create_task(storage_service.run_storage_collector())
+    collection_service.start_conversion_pool()
+    try:
+        yield
+    finally:
+        sweeper.cancel()
+        storage_collector.cancel()
+        await cache.stop_chat_writer(chat_writer)
+        await cache.close_cache()
+        collection_service.shutdown_conversion_pool()
+        log.stop()
     print("FastAPI application is shutting down…")
 
 # ─── App Initialization ───────────────────────────────────────────────────────
@@ -31,7 +62,8 @@ app = FastAPI(
     title="DocParser API",
     description="An API for parsing documents, generating learning materials, and chatting with your content.",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=MongoORJSONResponse
 )
 
 # ─── CORS ─────────────────────────────────────────────────────────────────────
@@ -55,27 +87,11 @@ app.include_router(user.router,          prefix="/api/user", tags=["User"])
 # Only mount the hashed assets directory—Vite puts everything under /assets
 app.mount("/assets", StaticFiles(directory=ASSETS_DIR), name="assets")
 
-# ─── Favicon, if you have one ─────────────────────────────────────────────────
-@app.get("/favicon.ico", include_in_schema=False)
-async def favicon():
-    ico_path = os.path.join(SPA_DIST, "favicon.ico")
-    return FileResponse(ico_path) if os.path.exists(ico_path) else FileResponse(INDEX_FILE)
-
 # ─── API Health Check ─────────────────────────────────────────────────────────
 @app.get("/api", tags=["Root"])
 def read_root():
     return {"status": "DocParser API is online and running."}
 
-# ─── Serve index.html at / ────────────────────────────────────────────────────
-@app.get("/", include_in_schema=False)
-async def serve_index():
-    return FileResponse(INDEX_FILE)
-
-# ─── Catch‑all for Client‑side Routes ──────────────────────────────────────────
-@app.get("/{full_path:path}", include_in_schema=False)
-async def spa_fallback(full_path: str):
-    """
-    Any GET that isn’t /api/... or /assets/... will land here.
-    Return index.html so React Router can handle the route.
-    """
-    return FileResponse(INDEX_FILE)
+# ─── SPA: index.html at /, static files, and client-side route fallback ──────────
+# Mounted last so it only handles requests that no API route or /assets matched.
+app.mount("/", SPAStaticFiles(directory=SPA_DIST, html=True), name="spa")
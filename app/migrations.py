@@ -1,8 +1,16 @@
+import os
 import sys
-from pymongo import ASCENDING
+import asyncio
+import datetime
+from pymongo import ASCENDING, DESCENDING, UpdateOne
 from pymongo.asynchronous.database import AsyncDatabase
 from pymongo.errors import OperationFailure
 
+# Bump this whenever SCHEMAS or INDEXES change so the next startup re-runs the full check.
+MIGRATIONS_VERSION = 6
+META_COLLECTION = "_meta"
+MIGRATIONS_META_ID = "migrations"
+
 # --- Collection Schema Definitions ---
 SCHEMAS = {
     "User": {
@@ -46,6 +54,10 @@ SCHEMAS = {
                     "bsonType": ["long", "int"],
                     "description": "Total character count of all content in the collection. Defaults to 0."
                 },
+                "docCount": {
+                    "bsonType": ["long", "int"],
+                    "description": "Number of Content documents in the collection, used to enforce the upload quota."
+                },
                 "createdAt": {"bsonType": "date", "description": "must be a date and is required"},
                 "updatedAt": {"bsonType": "date", "description": "must be a date and is required"}
             }
@@ -136,6 +148,17 @@ SCHEMAS = {
                 "updatedAt": {"bsonType": "date"}
             }
         }
+    },
+    "PendingFileDeletion": {
+        "$jsonSchema": {
+            "bsonType": "object",
+            "required": ["_id", "checksum", "queuedAt"],
+            "properties": {
+                "_id": {"bsonType": "string", "description": "The storage filename (checksum + suffix)."},
+                "checksum": {"bsonType": "string"},
+                "queuedAt": {"bsonType": "date"}
+            }
+        }
     }
 }
 
@@ -144,17 +167,22 @@ SCHEMAS = {
 # efficient queries. The format is { "collection_name": [index_definitions] }.
 INDEXES = {
     "Collection": [
-        [("userId", ASCENDING)]  # To quickly find all collections for a user.
+        [("userId", ASCENDING), ("updatedAt", DESCENDING)]  # To quickly find all collections for a user, most recently updated first.
     ],
     "Content": [
-        [("collectionId", ASCENDING)],  # To quickly find all content in a collection.
+        [("collectionId", ASCENDING), ("userId", ASCENDING)],  # To quickly find all content in a collection, also scoped to its owner.
         [("checksum", ASCENDING), ("collectionId", ASCENDING)] # Compound index to quickly check for duplicates within a collection.
     ],
     "ChatSession": [
-        [("collectionId", ASCENDING), ("userId", ASCENDING)] # Compound index to quickly find a specific user's chat session in a collection.
+        (
+            [("collectionId", ASCENDING), ("userId", ASCENDING)],
+            {"unique": True} # Finds a user's chat session in a collection; the chat upserts rely on there being only one.
+        )
     ],
     "ReinforcementItem": [
-        [("collectionId", ASCENDING), ("userId", ASCENDING)],
+        # Serves the per-type item lookups (latest first) on the generation paths for every type,
+        # not only the ones the partial unique index below covers, and by prefix the user's item list.
+        [("collectionId", ASCENDING), ("userId", ASCENDING), ("type", ASCENDING), ("createdAt", DESCENDING)],
         (
             [("collectionId", ASCENDING), ("userId", ASCENDING), ("type", ASCENDING)],
             {
@@ -168,6 +196,9 @@ INDEXES = {
             [("contentId", ASCENDING), ("userId", ASCENDING), ("type", ASCENDING)],
             {"unique": True} # Enforces one mindmap/summary per user per document
         )
+    ],
+    "PendingFileDeletion": [
+        [("queuedAt", ASCENDING)]  # The storage collector picks up entries whose grace period is over.
     ]
 }
 
@@ -203,13 +234,101 @@ async def check_admin_rights(db: AsyncDatabase) -> bool:
         return False
 
 
+def _normalize_keys(keys) -> tuple:
+    """Normalizes an index key spec so specs from INDEXES and from the server compare equal."""
+    return tuple((field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in keys)
+
+
+# Index options that change what an index enforces; an existing index whose options differ
+# from INDEXES is rebuilt rather than reported as present.
+COMPARED_INDEX_OPTIONS = ("unique", "partialFilterExpression")
+
+
+def _compared_options(opts: dict) -> dict:
+    return {name: opts[name] for name in COMPARED_INDEX_OPTIONS if opts.get(name)}
+
+
+async def _existing_indexes(db: AsyncDatabase, collection_name: str) -> dict[tuple, tuple[str, dict]]:
+    """Maps the normalized key spec of each index on a collection to (index name, compared options)."""
+    info = await db[collection_name].index_information()
+    return {_normalize_keys(spec["key"]): (name, _compared_options(spec)) for name, spec in info.items()}
+
+
+async def _find_duplicates(db: AsyncDatabase, collection_name: str, keys, opts: dict) -> list[list]:
+    """Returns the _ids of each group of documents that would violate a unique index on `keys`."""
+    pipeline = []
+    if opts.get("partialFilterExpression"):
+        pipeline.append({"$match": opts["partialFilterExpression"]})
+    pipeline += [
+        {"$group": {"_id": {field: f"${field}" for field, _ in keys}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ]
+    cursor = await db[collection_name].aggregate(pipeline, allowDiskUse=True)
+    return [group["ids"] async for group in cursor]
+
+
+async def _ensure_index(db: AsyncDatabase, collection_name: str, keys, opts: dict, replaces: str | None):
+    """Creates an index; `replaces` names an existing index on the same keys with other options."""
+    if replaces:
+        if opts.get("unique"):
+            # Duplicates are user data (chat history, generated items), so they are never deleted
+            # here; the old index stays until they are resolved by hand and the next start retries.
+            duplicates = await _find_duplicates(db, collection_name, keys, opts)
+            if duplicates:
+                for ids in duplicates:
+                    print(f"⚠️ Conflicting documents in '{collection_name}' for keys={keys}: {ids}")
+                raise RuntimeError(f"{len(duplicates)} group(s) of duplicate documents must be resolved before keys={keys} can be made unique.")
+        await db[collection_name].drop_index(replaces)
+        print(f"✔️ Dropped index '{replaces}' on '{collection_name}' to rebuild it with options={opts}.")
+    await db[collection_name].create_index(keys, **opts)
+
+
+async def _backfill_doc_counts(db: AsyncDatabase) -> bool:
+    """Sets docCount on collections created before it was tracked. Returns False on failure."""
+    try:
+        cursor = await db["Collection"].aggregate([
+            {"$match": {"docCount": {"$exists": False}}},
+            {"$lookup": {
+                "from": "Content",
+                "localField": "_id",
+                "foreignField": "collectionId",
+                "pipeline": [{"$project": {"_id": 1}}],
+                "as": "contents"
+            }},
+            {"$project": {"count": {"$size": "$contents"}}}
+        ])
+        ops = [
+            UpdateOne({"_id": doc["_id"], "docCount": {"$exists": False}}, {"$set": {"docCount": doc["count"]}})
+            async for doc in cursor
+        ]
+        if ops:
+            await db["Collection"].bulk_write(ops, ordered=False)
+        print(f"✔️ Backfilled docCount on {len(ops)} collection(s).")
+        return True
+    except Exception as e:
+        print(f"❌ FAILED to backfill docCount on collections. Error: {e}")
+        return False
+
+
 async def run_migrations(db: AsyncDatabase):
     """
     Checks for existing collections and creates them with validators if they don't exist.
     Also ensures that all necessary indexes are created for each collection.
     """
+    if os.getenv("SKIP_MIGRATIONS") == "1":
+        print("--- SKIP_MIGRATIONS=1 set. Skipping database migration check. ---")
+        return
+
     print("\n--- Starting Database Migration Check ---")
-    
+
+    try:
+        meta = await db[META_COLLECTION].find_one({"_id": MIGRATIONS_META_ID})
+        if meta and meta.get("version") == MIGRATIONS_VERSION:
+            print(f"--- Database is already at migration version {MIGRATIONS_VERSION}. Nothing to do. ---\n")
+            return
+    except Exception as e:
+        print(f"⚠️ WARNING: Could not read migration version, running full check. Error: {e}")
+
     if not await check_admin_rights(db):
         print("--- Migration check failed due to insufficient permissions. ---")
         return
@@ -218,30 +337,83 @@ async def run_migrations(db: AsyncDatabase):
     try:
         existing_collections = await db.list_collection_names()
         print(f"Found existing collections: {existing_collections}")
-        for name, validator in SCHEMAS.items():
-            if name not in existing_collections:
-                print(f"Collection '{name}' not found. Attempting to create...")
-                await db.create_collection(name, validator=validator)
+        missing = [name for name in SCHEMAS if name not in existing_collections]
+        for name in missing:
+            print(f"Collection '{name}' not found. Attempting to create...")
+        results = await asyncio.gather(
+            *(db.create_collection(name, validator=SCHEMAS[name]) for name in missing),
+            return_exceptions=True
+        )
+        failed = False
+        for name, result in zip(missing, results):
+            if isinstance(result, Exception):
+                print(f"❌ ERROR creating collection '{name}'. Error: {result}")
+                failed = True
+            else:
                 print(f"👍 Collection '{name}' created successfully with validation schema.")
+        if failed:
+            print("❌ ERROR during collection creation. Aborting migration.")
+            return
     except Exception as e:
         print(f"❌ ERROR during collection creation. Aborting migration. Error: {e}")
         return
 
     # --- 2. Create Indexes for Performance ---
     print("\n--- Verifying Database Indexes ---")
+    # Fetch existing indexes once per collection so warm restarts skip create_index entirely.
+    collection_names = list(INDEXES)
+    existing_results = await asyncio.gather(
+        *(_existing_indexes(db, name) for name in collection_names),
+        return_exceptions=True
+    )
+    existing_indexes = {
+        name: result if not isinstance(result, Exception) else {}
+        for name, result in zip(collection_names, existing_results)
+    }
+
+    # Flatten to (collection_name, keys, options, replaced index) so every missing or outdated
+    # index can be (re)built concurrently.
+    index_specs = []
     for collection_name, index_list in INDEXES.items():
-        collection = db[collection_name]
         for idx in index_list:
-            try:
-                if isinstance(idx, tuple):
-                    # idx == (keys, opts)
-                    keys, opts = idx
-                    await collection.create_index(keys, **opts)
-                    print(f"✔️ Index on '{collection_name}' with keys={keys} and options={opts} is present.")
-                else:
-                    # idx == keys only
-                    await collection.create_index(idx)
-                    print(f"✔️ Index on '{collection_name}' with keys={idx} is present.")
-            except Exception as e:
-                print(f"❌ FAILED to create index on '{collection_name}' for spec {idx!r}. Error: {e}")
+            # idx is either (keys, opts) or just keys
+            keys, opts = idx if isinstance(idx, tuple) else (idx, {})
+            existing = existing_indexes[collection_name].get(_normalize_keys(keys))
+            if existing is None:
+                index_specs.append((collection_name, keys, opts, None))
+            elif existing[1] != _compared_options(opts):
+                # Same keys, different options (e.g. a plain index that now has to be unique)
+                index_specs.append((collection_name, keys, opts, existing[0]))
+            else:
+                print(f"✔️ Index on '{collection_name}' with keys={keys} already exists.")
+
+    results = await asyncio.gather(
+        *(_ensure_index(db, name, keys, opts, replaces) for name, keys, opts, replaces in index_specs),
+        return_exceptions=True
+    )
+    indexes_ok = True
+    for (collection_name, keys, opts, _), result in zip(index_specs, results):
+        if isinstance(result, Exception):
+            indexes_ok = False
+            print(f"❌ FAILED to create index on '{collection_name}' for keys={keys} and options={opts}. Error: {result}")
+        elif opts:
+            print(f"✔️ Index on '{collection_name}' with keys={keys} and options={opts} is present.")
+        else:
+            print(f"✔️ Index on '{collection_name}' with keys={keys} is present.")
+
+    # --- 3. Backfill derived fields on existing documents ---
+    print("\n--- Backfilling Derived Fields ---")
+    backfill_ok = await _backfill_doc_counts(db)
+
+    # --- 4. Record the migration version so restarts can skip the check ---
+    if indexes_ok and backfill_ok:
+        try:
+            await db[META_COLLECTION].update_one(
+                {"_id": MIGRATIONS_META_ID},
+                {"$set": {"version": MIGRATIONS_VERSION, "updatedAt": datetime.datetime.now(datetime.timezone.utc)}},
+                upsert=True
+            )
+            print(f"✔️ Recorded migration version {MIGRATIONS_VERSION}.")
+        except Exception as e:
+            print(f"⚠️ WARNING: Could not record migration version. Error: {e}")
     print("--- Database Migration Check Complete ---\n")
@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from bson import ObjectId
 
-from app.auth import get_current_user_id
+from app.auth import UserId, SourceIds
 from app.database import contents_db
 from app.models import DocumentAnalysisOut
 from app.services import analysis_service
+from app.utils import document_etag, etag_matches
 
 router = APIRouter(
     prefix="/collections/{collection_id}/sources/{source_id}/analysis",
@@ -12,27 +13,36 @@ router = APIRouter(
 )
 
 async def verify_source_ownership(
-    collection_id: str,
-    source_id: str,
-    user_id: ObjectId = Depends(get_current_user_id)
+    ids: SourceIds,
+    user_id: UserId
 ):
     """Dependency to verify user owns the collection and the source belongs to it."""
-    if not (ObjectId.is_valid(collection_id) and ObjectId.is_valid(source_id)):
-        raise HTTPException(status_code=400, detail="Invalid ID format.")
-
+    cid, sid = ids
     content_doc = await contents_db.find_one({
-        "_id": ObjectId(source_id),
-        "collectionId": ObjectId(collection_id),
+        "_id": sid,
+        "collectionId": cid,
         "userId": user_id
-    })
+    }, projection={"_id": 1})
     if not content_doc:
         raise HTTPException(status_code=404, detail="Source not found in this collection or access denied.")
     
     return user_id
 
+def _tagged(request: Request, response: Response, doc: dict):
+    """Tags an analysis document with an ETag, answering 304 if the client already has it."""
+    etag = document_etag(doc)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return doc
+
+# The GET routes return the raw document: response_model validates it once, whereas
+# building DocumentAnalysisOut here would validate it a second time.
 @router.get("/mindmap", response_model=DocumentAnalysisOut)
 async def get_or_create_document_mindmap(
-    source_id: str,
+    request: Request,
+    response: Response,
+    ids: SourceIds,
     user_id: ObjectId = Depends(verify_source_ownership),
     regenerate: bool = Query(False, description="Set to true to force regeneration.")
 ):
@@ -41,25 +51,27 @@ async def get_or_create_document_mindmap(
     Generates a new one if it doesn't exist or if regeneration is requested.
     """
     mindmap_doc = await analysis_service.get_or_create_analysis(
-        content_id=source_id,
+        content_id=ids[1],
         user_id=user_id,
         analysis_type="mindMap",
         regenerate=regenerate
     )
-    return DocumentAnalysisOut(**mindmap_doc)
+    return _tagged(request, response, mindmap_doc)
 
 @router.delete("/mindmap", status_code=204)
 async def delete_document_mindmap(
-    source_id: str,
+    ids: SourceIds,
     user_id: ObjectId = Depends(verify_source_ownership)
 ):
     """Deletes the mind map for a single document."""
-    await analysis_service.delete_document_mind_map(source_id, user_id)
+    await analysis_service.delete_document_mind_map(ids[1], user_id)
     return Response(status_code=204)
 
 @router.get("/summary", response_model=DocumentAnalysisOut)
 async def get_or_create_document_summary(
-    source_id: str,
+    request: Request,
+    response: Response,
+    ids: SourceIds,
     user_id: ObjectId = Depends(verify_source_ownership),
     regenerate: bool = Query(False, description="Set to true to force regeneration.")
 ):
@@ -69,9 +81,9 @@ async def get_or_create_document_summary(
     Summaries cannot be deleted directly.
     """
     summary_doc = await analysis_service.get_or_create_analysis(
-        content_id=source_id,
+        content_id=ids[1],
         user_id=user_id,
         analysis_type="summary",
         regenerate=regenerate
     )
-    return DocumentAnalysisOut(**summary_doc)
+    return _tagged(request, response, summary_doc)
@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, Response
+import asyncio
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
 
 from app.database import chats_db, collections_db
-from app.models import ChatSessionOut, ChatRequest, ChatMessage
-from app.auth import get_current_user_id
+from app.models import ChatSessionOut, ChatRequest
+from app.auth import UserId, CollectionId, OwnedCollectionId
 from app.services import chat_service
 
 router = APIRouter(
@@ -11,39 +13,59 @@ router = APIRouter(
     tags=["Chat"]
 )
 
-@router.post("", response_model=ChatMessage)
-async def chat_with_collection(collection_id: str, request: ChatRequest, user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-    
-    if not await collections_db.find_one({"_id": ObjectId(collection_id), "userId": user_id}):
+async def _get_owned_chat_session(cid: ObjectId, user_id: ObjectId, last_messages: int | None = None) -> dict | None:
+    """
+    Verifies collection ownership and fetches the user's chat session in a single round-trip.
+    Raises 404 if the collection isn't the user's; returns None if no session exists yet.
+    With last_messages, only that many of the most recent messages are sent back by Mongo.
+    """
+    session_pipeline = [{"$match": {"userId": user_id}}, {"$limit": 1}]
+    if last_messages is not None:
+        session_pipeline.append({"$set": {"messages": {"$slice": ["$messages", -last_messages]}}})
+
+    cursor = await collections_db.aggregate([
+        {"$match": {"_id": cid, "userId": user_id}},
+        {"$lookup": {
+            "from": chats_db.name,
+            "localField": "_id",
+            "foreignField": "collectionId",
+            "pipeline": session_pipeline,
+            "as": "sessions"
+        }},
+        {"$project": {"sessions": 1}}
+    ])
+    result = await cursor.to_list(1)
+    if not result:
         raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
+    return next(iter(result[0]["sessions"]), None)
+
+@router.post("", response_class=StreamingResponse)
+async def chat_with_collection(request: ChatRequest, cid: CollectionId, user_id: UserId):
+    """Streams the assistant's reply as Server-Sent Events (see chat_service.stream_chat_response)."""
+    # Start the Qdrant retrieval while Mongo checks ownership; it's only consumed once that passes
+    retrieval = asyncio.create_task(chat_service.retrieve_collection_docs(str(cid), request.query))
+    try:
+        session_doc = await _get_owned_chat_session(cid, user_id, last_messages=chat_service.CHAT_HISTORY_WINDOW)
+    except BaseException:
+        retrieval.cancel()
+        raise
 
-    assistant_message = await chat_service.get_chat_response(collection_id, request, user_id)
-    return assistant_message
+    return StreamingResponse(
+        chat_service.stream_chat_response(cid, session_doc, retrieval, request, user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @router.get("_session", response_model=ChatSessionOut) # Using _session to avoid route collision with /chat
-async def get_chat_session(collection_id: str, user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-    
-    if not await collections_db.find_one({"_id": ObjectId(collection_id), "userId": user_id}):
-        raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
-        
-    session_doc = await chats_db.find_one({"collectionId": ObjectId(collection_id), "userId": user_id})
+async def get_chat_session(cid: CollectionId, user_id: UserId):
+    session_doc = await _get_owned_chat_session(cid, user_id)
     if not session_doc:
         raise HTTPException(status_code=404, detail="No chat session has been started for this collection.")
-        
-    return ChatSessionOut(**session_doc)
 
-@router.delete("_session", status_code=204)
-async def delete_chat_session(collection_id: str, user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-    cid = ObjectId(collection_id)
+    # response_model validates the document once; building ChatSessionOut here would validate it twice
+    return session_doc
 
-    if not await collections_db.find_one({"_id": cid, "userId": user_id}):
-        raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
-    
+@router.delete("_session", status_code=204)
+async def delete_chat_session(cid: OwnedCollectionId, user_id: UserId):
     await chats_db.delete_one({"collectionId": cid, "userId": user_id})
     return Response(status_code=204)
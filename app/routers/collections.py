@@ -1,156 +1,185 @@
+import asyncio
 import datetime
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Response
+from fastapi import APIRouter, HTTPException, UploadFile, File, Request, Response
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
-from qdrant_client import models
-from qdrant_client.http.models import VectorParams, Distance
 
 from app.database import collections_db, contents_db, qdrant_client
 from app.models import CollectionOut, ContentOut, RenameSourceRequest, YoutubeRequest, RenameCollectionRequest
-from app.auth import get_current_user_id
+from app.auth import UserId, CollectionId, SourceIds
 from app.services import collection_service
 from app.services import storage_service
-from app.services.collection_service import ALLOWED_MIME_TYPES
+from app.services import qdrant_service
+from app.services.collection_service import FORMAT_TO_MIME
+from app.services.auth_cache import user_owns_collection
+from app.utils import MongoORJSONResponse, make_etag, etag_matches
+from app import cache
 
 router = APIRouter(
     prefix="/collections",
     tags=["Collections & Sources"]
 )
 
+# Projections matching CollectionOut / ContentOut, so internal fields like charCount stay in Mongo
+COLLECTION_PROJECTION = {"userId": 1, "name": 1, "totalChars": 1, "createdAt": 1, "updatedAt": 1}
+SOURCE_PROJECTION = {"userId": 1, "collectionId": 1, "sourceType": 1, "fileInfo": 1, "checksum": 1, "uploadedAt": 1}
+
+# ─── Response Cache Keys ──────────────────────────────────────────────────────
+def _collections_key(user_id: ObjectId) -> str:
+    return f"collections:{user_id}"
+
+def _collection_key(user_id: ObjectId, cid: ObjectId) -> str:
+    return f"collection:{user_id}:{cid}"
+
+def _sources_key(user_id: ObjectId, cid: ObjectId) -> str:
+    return f"sources:{user_id}:{cid}"
+
+async def _invalidate_collection(user_id: ObjectId, cid: ObjectId):
+    """Drops every cached GET response that reflects this collection (name, totalChars or sources)."""
+    await cache.invalidate_responses(_collections_key(user_id), _collection_key(user_id, cid), _sources_key(user_id, cid))
+
+def _json_response(request: Request, body: str | bytes) -> Response:
+    """Sends a JSON body tagged with an ETag, or a bodiless 304 if the client already has it."""
+    if isinstance(body, str):
+        body = body.encode()
+    etag = make_etag(body)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+async def _cache_response(request: Request, key: str, content) -> Response:
+    """Renders content to JSON once, caching the body for subsequent GETs."""
+    body = MongoORJSONResponse(content).body
+    await cache.set_cached_response(key, body)
+    return _json_response(request, body)
+
 @router.get("", response_model=list[CollectionOut])
-async def get_all_collections(user_id: ObjectId = Depends(get_current_user_id)):
-    collections_list = []
-    cursor = collections_db.find({"userId": user_id})
-    async for doc in cursor:
-        collections_list.append(CollectionOut(**doc))
-    return collections_list
+async def get_all_collections(request: Request, user_id: UserId):
+    key = _collections_key(user_id)
+    if (body := await cache.get_cached_response(key)) is not None:
+        return _json_response(request, body)
+
+    # Documents come straight from our own writes, so they are serialized as-is rather than
+    # re-validated through CollectionOut one by one.
+    collections_list = await collections_db.find({"userId": user_id}, projection=COLLECTION_PROJECTION).to_list()
+    return await _cache_response(request, key, collections_list)
 
 @router.post("", response_model=CollectionOut, status_code=201)
-async def create_collection(name: str, user_id: ObjectId = Depends(get_current_user_id)):
+async def create_collection(name: str, user_id: UserId):
     now = datetime.datetime.now(datetime.timezone.utc)
-    new_collection = {"userId": user_id, "name": name, "totalChars": 0, "createdAt": now, "updatedAt": now}
-    result = await collections_db.insert_one(new_collection)
-    collection_id = result.inserted_id
-    
-    # Ensure Qdrant collection is created
-    qdrant_client.recreate_collection(
-        collection_name=str(collection_id),
-        vectors_config=VectorParams(size=3072, distance=Distance.COSINE)
+    # Generate the ID client-side so the Mongo document and the Qdrant collection can be created together
+    collection_id = ObjectId()
+    new_collection = {"_id": collection_id, "userId": user_id, "name": name, "totalChars": 0, "docCount": 0, "createdAt": now, "updatedAt": now}
+
+    # The ID is brand new, so the Qdrant collection is created rather than recreated;
+    # the sync client runs in a worker thread to keep the event loop free.
+    insert_result, qdrant_result = await asyncio.gather(
+        collections_db.insert_one(new_collection),
+        asyncio.to_thread(qdrant_service.create_vector_collection, str(collection_id)),
+        return_exceptions=True
     )
-    
-    new_collection["_id"] = collection_id
+
+    if isinstance(insert_result, Exception) or isinstance(qdrant_result, Exception):
+        # Undo whichever side succeeded so neither store is left with an orphan
+        print(f"ERROR: Failed to create collection {collection_id}. Mongo: {insert_result!r}, Qdrant: {qdrant_result!r}")
+        try:
+            if not isinstance(insert_result, Exception):
+                await collections_db.delete_one({"_id": collection_id})
+            if not isinstance(qdrant_result, Exception):
+                await asyncio.to_thread(qdrant_client.delete_collection, collection_name=str(collection_id))
+        except Exception as e:
+            print(f"WARNING: Rollback of collection {collection_id} failed and may need manual cleanup. Error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to create collection.")
+
+    await cache.invalidate_responses(_collections_key(user_id))
     return new_collection
 
 @router.get("/{collection_id}", response_model=CollectionOut)
-async def get_single_collection(collection_id: str, user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-    
-    collection_doc = await collections_db.find_one({"_id": ObjectId(collection_id), "userId": user_id})
+async def get_single_collection(request: Request, cid: CollectionId, user_id: UserId):
+    key = _collection_key(user_id, cid)
+    if (body := await cache.get_cached_response(key)) is not None:
+        return _json_response(request, body)
+
+    collection_doc = await collections_db.find_one({"_id": cid, "userId": user_id}, projection=COLLECTION_PROJECTION)
     if not collection_doc:
         raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
-    return CollectionOut(**collection_doc)
+    return await _cache_response(request, key, collection_doc)
 
 @router.patch("/{collection_id}", response_model=CollectionOut)
-async def rename_collection(collection_id: str, request: RenameCollectionRequest, user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-    
-    updated_doc = await collection_service.rename_collection(collection_id, request.newName, user_id)
+async def rename_collection(request: RenameCollectionRequest, cid: CollectionId, user_id: UserId):
+    updated_doc = await collection_service.rename_collection(cid, request.newName, user_id)
+    await _invalidate_collection(user_id, cid)
     return CollectionOut(**updated_doc)
 
 @router.delete("/{collection_id}", status_code=204)
-async def delete_collection(collection_id: str, user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-        
-    await collection_service.delete_collection_and_dependents(collection_id, user_id)
+async def delete_collection(cid: CollectionId, user_id: UserId):
+    await collection_service.delete_collection_and_dependents(cid, user_id)
+    await _invalidate_collection(user_id, cid)
     return Response(status_code=204)
 
 @router.get("/{collection_id}/sources", response_model=list[ContentOut])
-async def get_collection_sources(collection_id: str, user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-    cid = ObjectId(collection_id)
-    
-    if not await collections_db.find_one({"_id": cid, "userId": user_id}):
-        raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
-        
-    sources_list = []
-    cursor = contents_db.find({"collectionId": cid})
-    async for doc in cursor:
-        sources_list.append(ContentOut(**doc))
-    return sources_list
-
-@router.post("/{collection_id}/upload", response_model=list[ContentOut], status_code=201)
-async def upload_multiple_files(collection_id: str, files: list[UploadFile] = File(...), user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-    cid = ObjectId(collection_id)
+async def get_collection_sources(request: Request, cid: CollectionId, user_id: UserId):
+    key = _sources_key(user_id, cid)
+    if (body := await cache.get_cached_response(key)) is not None:
+        return _json_response(request, body)
 
-    if not await collections_db.find_one({"_id": cid, "userId": user_id}):
+    if not await user_owns_collection(cid, user_id):
         raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
 
-    current_doc_count = await contents_db.count_documents({"collectionId": cid})
-    if current_doc_count + len(files) > 20:
-        raise HTTPException(
-            status_code=413,
-            detail=f"This upload would exceed the 20 document limit. You have {current_doc_count} documents."
-        )
+    sources_list = await contents_db.find({"collectionId": cid}, projection=SOURCE_PROJECTION).to_list()
+    return await _cache_response(request, key, sources_list)
 
-    processed_docs = await collection_service.process_uploaded_files(collection_id, files, user_id)
+@router.post("/{collection_id}/upload", response_model=list[ContentOut], status_code=201)
+async def upload_multiple_files(cid: CollectionId, user_id: UserId, files: list[UploadFile] = File(...)):
+    # Checks ownership and the document quota in one atomic update
+    await collection_service.reserve_document_slots(cid, user_id, len(files))
+
+    processed_docs = []
+    try:
+        processed_docs = await collection_service.process_uploaded_files(cid, files, user_id)
+    finally:
+        await collection_service.release_document_slots(cid, len(files) - len(processed_docs))
+    await _invalidate_collection(user_id, cid)
     return processed_docs
 
 @router.post("/{collection_id}/upload/youtube", response_model=ContentOut, status_code=201)
-async def upload_youtube_url(collection_id: str, request: YoutubeRequest, user_id: ObjectId = Depends(get_current_user_id)):
-    if not ObjectId.is_valid(collection_id):
-        raise HTTPException(status_code=400, detail="Invalid collection ID format.")
-    cid = ObjectId(collection_id)
-
-    if not await collections_db.find_one({"_id": cid, "userId": user_id}):
-        raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
-
-    current_doc_count = await contents_db.count_documents({"collectionId": cid})
-    if current_doc_count + 1 > 20:
-        raise HTTPException(status_code=413, detail="This upload would exceed the 20 document limit.")
-
-    content_doc = await collection_service.process_youtube_url(collection_id, request.url, user_id)
+async def upload_youtube_url(request: YoutubeRequest, cid: CollectionId, user_id: UserId):
+    await collection_service.reserve_document_slots(cid, user_id, 1)
+
+    try:
+        content_doc = await collection_service.process_youtube_url(cid, request.url, user_id)
+    except BaseException:
+        await collection_service.release_document_slots(cid, 1)
+        raise
+    await _invalidate_collection(user_id, cid)
     return content_doc
 
 @router.patch("/{collection_id}/sources/{source_id}", response_model=ContentOut)
-async def rename_source(collection_id: str, source_id: str, request: RenameSourceRequest, user_id: ObjectId = Depends(get_current_user_id)):
-    if not (ObjectId.is_valid(collection_id) and ObjectId.is_valid(source_id)):
-        raise HTTPException(status_code=400, detail="Invalid ID format.")
-
-    if not await collections_db.find_one({"_id": ObjectId(collection_id), "userId": user_id}):
-        raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
-    
-    updated_doc = await collection_service.rename_source_in_dbs(collection_id, source_id, request.newName)
+async def rename_source(request: RenameSourceRequest, ids: SourceIds, user_id: UserId):
+    cid, sid = ids
+    updated_doc = await collection_service.rename_source_in_dbs(cid, sid, request.newName, user_id)
+    await _invalidate_collection(user_id, cid)
     return ContentOut(**updated_doc)
 
 @router.delete("/{collection_id}/sources/{source_id}", status_code=204)
-async def delete_source(collection_id: str, source_id: str, user_id: ObjectId = Depends(get_current_user_id)):
-    if not (ObjectId.is_valid(collection_id) and ObjectId.is_valid(source_id)):
-        raise HTTPException(status_code=400, detail="Invalid ID format.")
-
-    if not await collections_db.find_one({"_id": ObjectId(collection_id), "userId": user_id}):
-        raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
-
-    await collection_service.delete_source_from_dbs(collection_id, source_id)
+async def delete_source(ids: SourceIds, user_id: UserId):
+    cid, sid = ids
+    await collection_service.delete_source_from_dbs(cid, sid, user_id)
+    await _invalidate_collection(user_id, cid)
     return Response(status_code=204)
 
 @router.get("/{collection_id}/sources/{source_id}/file")
-async def get_source_file(collection_id: str, source_id: str, user_id: ObjectId = Depends(get_current_user_id)):
+async def get_source_file(ids: SourceIds, user_id: UserId):
     """
     Retrieves the actual file content for a source document.
     This is used for previewing the file on the frontend.
     """
-    if not (ObjectId.is_valid(collection_id) and ObjectId.is_valid(source_id)):
-        raise HTTPException(status_code=400, detail="Invalid ID format.")
+    cid, sid = ids
 
     # Verify ownership and get the document in a single database call
     source_doc = await contents_db.find_one({
-        "_id": ObjectId(source_id),
-        "collectionId": ObjectId(collection_id),
+        "_id": sid,
+        "collectionId": cid,
         "userId": user_id
     })
 
@@ -166,12 +195,8 @@ async def get_source_file(collection_id: str, source_id: str, user_id: ObjectId
         raise HTTPException(status_code=500, detail="Document metadata is incomplete and file cannot be retrieved.")
 
     # Determine the correct MIME type based on the format stored in the database
-    media_type = "application/octet-stream"  # Default fallback
-    for mime, details in ALLOWED_MIME_TYPES.items():
-        if details["format"] == doc_format:
-            media_type = mime
-            break
+    media_type = FORMAT_TO_MIME.get(doc_format, "application/octet-stream")
     
-    file_bytes = await storage_service.get_file_bytes(checksum, suffix)
-
-    return Response(content=file_bytes, media_type=media_type)
+    # Stream the file so large sources aren't buffered in memory per request
+    chunks, size = await storage_service.open_file_stream(checksum, suffix)
+    return StreamingResponse(chunks, media_type=media_type, headers={"Content-Length": str(size)})
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException
 from bson import ObjectId
 
-from app.auth import get_current_user_id
+from app.auth import UserId, SourceIds
 from app.database import contents_db
 from app.models import DocumentChatRequest, ChatMessage
 from app.services import chat_service
@@ -12,19 +12,16 @@ router = APIRouter(
 )
 
 async def verify_source_ownership(
-    collection_id: str,
-    source_id: str,
-    user_id: ObjectId = Depends(get_current_user_id)
+    ids: SourceIds,
+    user_id: UserId
 ):
     """Dependency to verify user owns the collection and the source belongs to it."""
-    if not (ObjectId.is_valid(collection_id) and ObjectId.is_valid(source_id)):
-        raise HTTPException(status_code=400, detail="Invalid ID format.")
-
+    cid, sid = ids
     content_doc = await contents_db.find_one({
-        "_id": ObjectId(source_id),
-        "collectionId": ObjectId(collection_id),
+        "_id": sid,
+        "collectionId": cid,
         "userId": user_id
-    })
+    }, projection={"_id": 1})
     if not content_doc:
         raise HTTPException(status_code=404, detail="Source not found in this collection or access denied.")
     
@@ -41,7 +38,7 @@ async def chat_with_document(
     Handles a chat request for a single document.
     The client provides a session_id to maintain an ephemeral chat state.
     """
-    # The service function now directly returns the ChatMessage model
+    # The service returns a ChatMessage-shaped dict, validated once by response_model
     return await chat_service.get_document_chat_response(
         collection_id=collection_id,
         source_id=source_id,
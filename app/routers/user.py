@@ -1,14 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException
-from bson import ObjectId
+from fastapi import APIRouter, HTTPException
 
 from app.database import users_db
 from app.models import UserOut
-from app.auth import get_current_user_id
+from app.auth import UserId
 
 router = APIRouter()
 
 @router.get("/me", response_model=UserOut)
-async def get_current_user_account(user_id: ObjectId = Depends(get_current_user_id)):
+async def get_current_user_account(user_id: UserId):
     """
     Retrieves the account details for the currently authenticated user.
     """
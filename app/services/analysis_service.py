@@ -1,10 +1,9 @@
-import os
-import tempfile
 import datetime
+from io import BytesIO
 from bson import ObjectId
 from fastapi import HTTPException
 from langchain_openai import ChatOpenAI
-from markitdown import MarkItDown
+from markitdown import MarkItDown, StreamInfo
 
 from app.database import document_analysis_db, contents_db
 from app.models import MindMap, Summary
@@ -14,6 +13,9 @@ from app.services import storage_service
 mindmap_llm = ChatOpenAI(model="gpt-4.1-mini").with_structured_output(MindMap)
 summary_llm = ChatOpenAI(model="gpt-4.1-mini").with_structured_output(Summary)
 
+# MarkItDown registers all of its converters on construction, so build it once
+_markitdown = MarkItDown()
+
 async def _get_document_text(content_doc: dict) -> str:
     """Helper to retrieve raw file bytes, process with MarkItDown, and return text."""
     checksum = content_doc.get("checksum")
@@ -25,27 +27,20 @@ async def _get_document_text(content_doc: dict) -> str:
 
     file_bytes = await storage_service.get_file_bytes(checksum, suffix)
     
-    tmp_path = ""
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(file_bytes)
-            tmp_path = tmp.name
-        
-        return MarkItDown().convert(tmp_path).text_content
+        # Convert from memory; the suffix tells MarkItDown which converter to use
+        return _markitdown.convert_stream(BytesIO(file_bytes), stream_info=StreamInfo(extension=suffix)).text_content
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to extract text from document: {e}")
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
 
 async def get_or_create_analysis(
-    content_id: str,
+    content_id: ObjectId,
     user_id: ObjectId,
     analysis_type: str, # "mindMap" or "summary"
     regenerate: bool = False
 ) -> dict:
     """Generic function to get or create a mind map or summary for a document."""
-    cid = ObjectId(content_id)
+    cid = content_id
 
     # 1. Handle regeneration by deleting the existing item first
     if regenerate:
@@ -89,10 +84,10 @@ async def get_or_create_analysis(
     
     return new_doc
 
-async def delete_document_mind_map(content_id: str, user_id: ObjectId):
+async def delete_document_mind_map(content_id: ObjectId, user_id: ObjectId):
     """Deletes a mind map for a specific document."""
     result = await document_analysis_db.delete_one({
-        "contentId": ObjectId(content_id),
+        "contentId": content_id,
         "userId": user_id,
         "type": "mindMap"
     })
@@ -0,0 +1,24 @@
+from bson import ObjectId
+from cachetools import TTLCache
+
+from app.database import collections_db
+
+OWNERSHIP_TTL_SECONDS = 30
+
+# Maps collection_id -> owning user_id. Ownership never changes, so only deletion
+# needs to evict; the short TTL bounds staleness across workers. Entries are only
+# read and written between awaits, so the event loop already serializes access.
+_collection_owners: TTLCache[ObjectId, ObjectId] = TTLCache(maxsize=10_000, ttl=OWNERSHIP_TTL_SECONDS)
+
+async def user_owns_collection(cid: ObjectId, user_id: ObjectId) -> bool:
+    """Checks collection ownership, skipping the database while a positive result is cached."""
+    if _collection_owners.get(cid) == user_id:
+        return True
+    if not await collections_db.find_one({"_id": cid, "userId": user_id}, projection={"_id": 1}):
+        return False
+    _collection_owners[cid] = user_id
+    return True
+
+def evict_collection(cid: ObjectId):
+    """Forgets a collection's owner, e.g. once the collection is deleted."""
+    _collection_owners.pop(cid, None)
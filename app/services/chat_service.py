@@ -1,43 +1,61 @@
+import asyncio
 import datetime
+from typing import AsyncIterator, Awaitable
 from bson import ObjectId
-from langchain_qdrant import QdrantVectorStore
+from fastapi import HTTPException
 from qdrant_client import models as qdrant_models
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.documents import Document
 
-from app.database import chats_db, qdrant_client, embeddings, llm
-from app.models import ChatMessage, ChatRequest, DocumentChatRequest
-from app.utils import format_docs
+from app.database import llm
+from app.services.qdrant_service import get_vector_store
+from app.models import ChatRequest, DocumentChatRequest
+from app.utils import format_docs, format_sse
 from app import cache
 
-async def _get_or_create_chat_session(collection_id: ObjectId, user_id: ObjectId) -> dict:
-    now = datetime.datetime.now(datetime.timezone.utc)
-    session = await chats_db.find_one({"collectionId": collection_id, "userId": user_id})
-    if session:
-        return session
-    new_session_doc = {"collectionId": collection_id, "userId": user_id, "messages": [], "status": "active", "createdAt": now, "updatedAt": now}
-    insert_result = await chats_db.insert_one(new_session_doc)
-    new_session_doc["_id"] = insert_result.inserted_id
-    return new_session_doc
-
-async def _save_chat_messages(session_id: ObjectId, user_message: ChatMessage, assistant_message: ChatMessage):
-    await chats_db.update_one(
-        {"_id": session_id},
-        {"$push": {"messages": {"$each": [user_message.model_dump(), assistant_message.model_dump()]}},
-         "$set": {"updatedAt": datetime.datetime.now(datetime.timezone.utc)}}
-    )
-
-async def get_chat_response(collection_id: str, request: ChatRequest, user_id: ObjectId) -> ChatMessage:
-    cid = ObjectId(collection_id)
-    session = await _get_or_create_chat_session(cid, user_id)
-    
-    vector_store = QdrantVectorStore(client=qdrant_client, collection_name=collection_id, embedding=embeddings)
-    retriever = vector_store.as_retriever(search_kwargs={"k": 3})
-
-    retrieved_docs = await retriever.ainvoke(request.query)
-    context_str = format_docs(retrieved_docs)
-
-    user_prompt_content = f"""Use the below context to answer the subsequent question. If the answer cannot be found in the context, write "I don't know."
+CHAT_HISTORY_WINDOW = 10  # Most recent messages sent to the LLM with each collection chat turn
+
+# Search the int8-quantized vectors, then rescore an oversampled shortlist against the
+# original vectors. Collections created without quantization ignore these params.
+SEARCH_PARAMS = qdrant_models.SearchParams(
+    quantization=qdrant_models.QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
+# Document chat searches a single source through the metadata.contentId payload index,
+# so a smaller HNSW beam is enough.
+DOCUMENT_SEARCH_PARAMS = qdrant_models.SearchParams(
+    hnsw_ef=64,
+    exact=False,
+    quantization=qdrant_models.QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
+
+# Stateless, so one chain serves every request
+_CHAIN = llm | StrOutputParser()
+
+async def retrieve_collection_docs(collection_id: str, query: str) -> list[Document]:
+    """Fetches the chunks of a collection most relevant to the query."""
+    return await get_vector_store(collection_id).asimilarity_search(query, k=3, search_params=SEARCH_PARAMS)
+
+async def stream_chat_response(
+    cid: ObjectId,
+    session: dict | None,
+    retrieval: Awaitable[list[Document]],
+    request: ChatRequest,
+    user_id: ObjectId
+) -> AsyncIterator[str]:
+    """
+    Streams the assistant's reply as Server-Sent Events: one `data: {"delta": ...}` event per
+    token, then a `done` event carrying the saved ChatMessage. Failures are sent as an `error`
+    event because the response headers have already gone out.
+    `session` is the caller's already-fetched ChatSession document, trimmed to the last
+    CHAT_HISTORY_WINDOW messages, or None for a first turn.
+    `retrieval` is the already-started retrieve_collection_docs call for this query.
+    """
+    try:
+        retrieved_docs = await retrieval
+        context_str = format_docs(retrieved_docs)
+
+        user_prompt_content = f"""Use the below context to answer the subsequent question. If the answer cannot be found in the context, write "I don't know."
 
 Context:
 \"\"\"
@@ -46,68 +64,80 @@ Context:
 
 Question: {request.query}
 """
-    recent_messages_dicts = session.get("messages", [])[-10:]
-    chat_history_messages = []
-    for msg in recent_messages_dicts:
-        role = msg.get("role")
-        content = msg.get("content")
-        if role == "user":
-            chat_history_messages.append(HumanMessage(content=content))
-        elif role == "assistant":
-            chat_history_messages.append(AIMessage(content=content))
-    
-    final_messages = [
-        SystemMessage(content="You are a helpful and concise study assistant."),
-        *chat_history_messages,
-        HumanMessage(content=user_prompt_content)
-    ]
-
-    chain = llm | StrOutputParser()
-    llm_response = await chain.ainvoke(final_messages)
-
-    user_msg = ChatMessage(role="user", content=request.query)
-    assistant_msg = ChatMessage(role="assistant", content=llm_response)
-    await _save_chat_messages(session["_id"], user_msg, assistant_msg)
-
-    return assistant_msg
+        recent_messages_dicts = session.get("messages", []) if session else []
+        chat_history_messages = []
+        for msg in recent_messages_dicts:
+            role = msg.get("role")
+            content = msg.get("content")
+            if role == "user":
+                chat_history_messages.append(HumanMessage(content=content))
+            elif role == "assistant":
+                chat_history_messages.append(AIMessage(content=content))
+
+        final_messages = [
+            SystemMessage(content="You are a helpful and concise study assistant."),
+            *chat_history_messages,
+            HumanMessage(content=user_prompt_content)
+        ]
+
+        # Messages are plain dicts in the stored ChatMessage shape; building and dumping
+        # ChatMessage models here would only re-validate data we just created.
+        user_msg = {"role": "user", "content": request.query, "timestamp": datetime.datetime.now(datetime.timezone.utc)}
+        response_chunks = []
+        async for token in _CHAIN.astream(final_messages):
+            response_chunks.append(token)
+            yield format_sse({"delta": token})
+
+        # Persist once, after the full reply has been streamed. The write-behind queue
+        # creates the session on its first turn and batches it with concurrent turns.
+        assistant_msg = {"role": "assistant", "content": "".join(response_chunks), "timestamp": datetime.datetime.now(datetime.timezone.utc)}
+        cache.queue_chat_messages(cid, user_id, [user_msg, assistant_msg])
+
+        yield format_sse(assistant_msg, event="done")
+    except HTTPException as e:
+        yield format_sse({"detail": e.detail}, event="error")
+    except Exception as e:
+        print(f"ERROR: Chat stream failed for collection {cid}: {e}")
+        yield format_sse({"detail": "Failed to generate a response."}, event="error")
 
 async def get_document_chat_response(
     collection_id: str,
     source_id: str,
     request: DocumentChatRequest,
     user_id: ObjectId
-) -> ChatMessage:
-    """Handles the logic for a single-document chat session (ephemeral)."""
+) -> dict:
+    """
+    Handles the logic for a single-document chat session (ephemeral).
+    Returns the assistant's reply as a ChatMessage-shaped dict.
+    """
     user_id_str = str(user_id)
     session_id = request.session_id
     
-    # 1. Get history from the cache. This handles all session creation and purging logic.
-    history = cache.get_or_create_session_history(session_id, user_id_str)
-    
-    # 2. Retrieve context from Qdrant using metadata filter
-    vector_store = QdrantVectorStore(client=qdrant_client, collection_name=collection_id, embedding=embeddings)
-    retriever = vector_store.as_retriever(
-        search_kwargs={
-            "k": 3,
-            "filter": qdrant_models.Filter(
+    # 1. Retrieve context from Qdrant using metadata filter while the cache resolves the
+    #    session history (which handles all session creation and purging logic).
+    history, retrieved_docs = await asyncio.gather(
+        cache.get_or_create_session_history(session_id, user_id_str),
+        get_vector_store(collection_id).asimilarity_search(
+            request.query,
+            k=3,
+            search_params=DOCUMENT_SEARCH_PARAMS,
+            filter=qdrant_models.Filter(
                 must=[qdrant_models.FieldCondition(key="metadata.contentId", match=qdrant_models.MatchValue(value=source_id))]
             )
-        }
+        )
     )
-    retrieved_docs = await retriever.ainvoke(request.query)
     context_str = format_docs(retrieved_docs)
 
-    # 3. Construct the prompt with history
+    # 2. Construct the prompt with history
     user_prompt_content = f"Use the context below to answer the question. If you don't know, say that.\n\nContext:\n\"\"\"\n{context_str}\n\"\"\"\n\nQuestion: {request.query}"
     
     chat_history_messages = []
     for msg_data in history:
-        # history is a list of model dicts, convert back to LangChain messages
-        msg = ChatMessage(**msg_data)
-        if msg.role == "user":
-            chat_history_messages.append(HumanMessage(content=msg.content))
+        # history is a list of message dicts we wrote ourselves, so read the fields directly
+        if msg_data["role"] == "user":
+            chat_history_messages.append(HumanMessage(content=msg_data["content"]))
         else:
-            chat_history_messages.append(AIMessage(content=msg.content))
+            chat_history_messages.append(AIMessage(content=msg_data["content"]))
 
     final_messages = [
         SystemMessage(content="You are a helpful and concise study assistant for a specific document."),
@@ -115,13 +145,14 @@ async def get_document_chat_response(
         HumanMessage(content=user_prompt_content)
     ]
 
-    # 4. Get LLM response
-    chain = llm | StrOutputParser()
-    llm_response = await chain.ainvoke(final_messages)
+    # 3. Get LLM response
+    llm_response = await _CHAIN.ainvoke(final_messages)
 
-    # 5. Save messages to cache
-    user_msg = ChatMessage(role="user", content=request.query)
-    assistant_msg = ChatMessage(role="assistant", content=llm_response)
-    cache.add_messages_to_history(session_id, [user_msg.model_dump(), assistant_msg.model_dump()])
+    # 4. Save messages to cache
+    now = datetime.datetime.now(datetime.timezone.utc)
+    user_msg = {"role": "user", "content": request.query, "timestamp": now}
+    assistant_msg = {"role": "assistant", "content": llm_response, "timestamp": now}
+    await cache.add_messages_to_history(session_id, [user_msg, assistant_msg])
 
+    # response_model=ChatMessage validates this once on the way out
     return assistant_msg
@@ -1,18 +1,27 @@
 import os
+import asyncio
+import hashlib
 import tempfile
 import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import tiktoken
 from fastapi import UploadFile, HTTPException
 from bson import ObjectId
 from markitdown import MarkItDown
 from pymongo import ReturnDocument
 from langchain_core.documents import Document
-from langchain_text_splitters import TokenTextSplitter
 from langchain_qdrant import QdrantVectorStore
 from qdrant_client import models
 
+from app import cache
 from app.services import storage_service
+from app.services.conversion_worker import convert_to_text
+from app.services.qdrant_service import get_vector_store
+from app.services.auth_cache import evict_collection
 from app.database import (
-    contents_db, collections_db, qdrant_client, embeddings, openai_client,
+    contents_db, collections_db, qdrant_client, openai_client,
     chats_db, reinforcement_db, document_analysis_db
 )
 from app.models import ContentOut
@@ -26,111 +35,378 @@ ALLOWED_MIME_TYPES = {
     "audio/mpeg": {"suffix": ".mp3", "format": "audio"},
     "audio/wav": {"suffix": ".wav", "format": "audio"},
 }
+# Reverse lookup for serving stored files; the first MIME type listed for a format wins
+FORMAT_TO_MIME = {}
+for _mime, _details in ALLOWED_MIME_TYPES.items():
+    FORMAT_TO_MIME.setdefault(_details["format"], _mime)
+
+MAX_DOCUMENTS_PER_COLLECTION = 20
+UPLOAD_CONCURRENCY = 4  # Files of one upload processed at the same time
+EMBEDDING_BATCH_SIZE = 256  # Chunks per embeddings request when indexing an upload
+
+CHUNK_TOKENS = 800  # Chunk size for embedding, in text-embedding-3-large tokens
+CHUNK_OVERLAP_TOKENS = 100
+TOKENIZER_THREADS = 8  # tiktoken batch threads, which run outside the GIL
+
+# Both are stateless once built, and building them is not free: MarkItDown registers all of
+# its converters and the encoding loads its BPE ranks, so share one of each.
+_markitdown = MarkItDown()
+_encoding = tiktoken.encoding_for_model("text-embedding-3-large")
+
+# PDF/Office parsing is CPU-bound, so it runs in worker processes rather than threads.
+# Every web worker has its own pool, so keep it small. Processes come from a forkserver:
+# forking this process would copy its gRPC channels and background threads into the child.
+CONVERSION_WORKERS = int(os.getenv("CONVERSION_WORKERS") or 2)
+_conversion_pool: ProcessPoolExecutor | None = None
+
+async def reserve_document_slots(cid: ObjectId, user_id: ObjectId, count: int):
+    """
+    Atomically claims `count` document slots on the user's collection by incrementing its
+    docCount, so concurrent uploads can't overshoot MAX_DOCUMENTS_PER_COLLECTION.
+    Raises 404 if the collection isn't the user's, 413 if the upload would exceed the limit.
+    """
+    while True:
+        reserved = await collections_db.find_one_and_update(
+            {"_id": cid, "userId": user_id, "docCount": {"$lte": MAX_DOCUMENTS_PER_COLLECTION - count}},
+            {"$inc": {"docCount": count}},
+            projection={"_id": 1}
+        )
+        if reserved:
+            return
+
+        # Only the failure path pays for a second read, to tell the errors apart
+        collection_doc = await collections_db.find_one({"_id": cid, "userId": user_id}, projection={"docCount": 1})
+        if not collection_doc:
+            raise HTTPException(status_code=404, detail="Collection not found or you do not have access.")
+        if "docCount" in collection_doc:
+            break
+        # Collections from before docCount was tracked lack the field until the migration
+        # backfills it, which may not have run; seed it from the contents and try again
+        existing = await contents_db.count_documents({"collectionId": cid})
+        await collections_db.update_one(
+            {"_id": cid, "docCount": {"$exists": False}},
+            {"$set": {"docCount": existing}}
+        )
 
-async def process_uploaded_files(
-    collection_id: str,
-    files: list[UploadFile],
-    user_id: ObjectId
-) -> list[ContentOut]:
-    cid = ObjectId(collection_id)
-    vector_store = QdrantVectorStore(client=qdrant_client, collection_name=collection_id, embedding=embeddings)
-    processed_docs: list[ContentOut] = []
-
-    for file in files:
-        if file.content_type not in ALLOWED_MIME_TYPES:
-            # In a real scenario, you might want to report which files failed
-            # but for now we raise immediately.
-            raise HTTPException(status_code=400, detail=f"Invalid file type for '{file.filename}'.")
-
-        file_bytes = await file.read()
-        checksum = compute_checksum(file_bytes)
+    raise HTTPException(
+        status_code=413,
+        detail=f"This upload would exceed the {MAX_DOCUMENTS_PER_COLLECTION} document limit. You have {collection_doc.get('docCount', 0)} documents."
+    )
 
-        # Prevent adding the exact same file to the same collection twice
-        if await contents_db.find_one({"collectionId": cid, "checksum": checksum}):
-            continue  # Skip duplicate file
+async def release_document_slots(cid: ObjectId, count: int):
+    """Returns reserved slots that did not end up holding a document (duplicates, failures)."""
+    if count > 0:
+        await collections_db.update_one({"_id": cid}, {"$inc": {"docCount": -count}})
+
+def _write_and_hash(tmp, hasher, chunk: bytes):
+    """Blocking half of _spool_upload; hashlib releases the GIL on large buffers, so run it in a worker thread."""
+    tmp.write(chunk)
+    hasher.update(chunk)
+
+async def _spool_upload(file: UploadFile, suffix: str) -> tuple[str, str, int]:
+    """
+    Copies an upload to a named temp file one STREAM_CHUNK_SIZE piece at a time, hashing as
+    it goes, so a large upload never sits in memory whole. Returns (tmp_path, checksum, size).
+    The caller removes the temp file.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=storage_service.SPOOL_DIR) as tmp:
+        try:
+            while chunk := await file.read(storage_service.STREAM_CHUNK_SIZE):
+                await asyncio.to_thread(_write_and_hash, tmp, hasher, chunk)
+                size += len(chunk)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    return tmp.name, hasher.hexdigest(), size
+
+def _transcribe(tmp_path: str) -> str:
+    """Blocking Whisper transcription of a spooled audio upload; run it in a worker thread."""
+    with open(tmp_path, "rb") as audio_file:
+        transcription = openai_client.audio.transcriptions.create(
+            file=audio_file,
+            model="whisper-1" # Or your preferred model
+        )
+        return transcription.text
+
+async def _extract_text(tmp_path: str, file_format: str) -> str:
+    """
+    Converts a spooled upload to text. Transcription is network-bound and runs in a thread;
+    document parsing is CPU-bound and runs in the conversion pool, outside this process's GIL.
+    """
+    if file_format == "audio":
+        return await asyncio.to_thread(_transcribe, tmp_path)
+    if _conversion_pool is None:
+        start_conversion_pool()
+    pool = _conversion_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, convert_to_text, tmp_path)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed on a huge file); replace the pool so later uploads still work.
+        # Concurrent conversions fail together, so only the first one swaps it out.
+        if _conversion_pool is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            start_conversion_pool()
+        raise
+
+def start_conversion_pool():
+    """Creates the conversion pool; its processes start on first use. Called from the app lifespan."""
+    global _conversion_pool
+    _conversion_pool = ProcessPoolExecutor(
+        max_workers=CONVERSION_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver")
+    )
 
-        file_details = ALLOWED_MIME_TYPES[file.content_type]
-        file_suffix = file_details["suffix"]
+def shutdown_conversion_pool():
+    """Stops the conversion worker processes. Called from the app lifespan on shutdown."""
+    global _conversion_pool
+    if _conversion_pool is not None:
+        _conversion_pool.shutdown(cancel_futures=True)
+        _conversion_pool = None
+
+def _source_points(source_id: str) -> models.FilterSelector:
+    """Selects every Qdrant point (chunk) that belongs to one source."""
+    return models.FilterSelector(
+        filter=models.Filter(
+            must=[models.FieldCondition(key="metadata.contentId", match=models.MatchValue(value=source_id))]
+        )
+    )
 
-        if not await contents_db.find_one({"checksum": checksum}):
-            await storage_service.save_file(
+def _split_documents(docs: list[Document]) -> list[Document]:
+    """
+    Blocking: splits whole source documents into overlapping CHUNK_TOKENS chunks (the same
+    windows TokenTextSplitter produces), tokenizing every document in one tiktoken batch so
+    the work is spread over threads instead of done one document at a time under the GIL.
+    """
+    token_lists = _encoding.encode_ordinary_batch([doc.page_content for doc in docs], num_threads=TOKENIZER_THREADS)
+    step = CHUNK_TOKENS - CHUNK_OVERLAP_TOKENS
+    chunks = []
+    for doc, tokens in zip(docs, token_lists):
+        starts = range(0, max(len(tokens) - CHUNK_OVERLAP_TOKENS, 1), step) if tokens else []
+        chunks.extend(_dedupe_chunks([
+            Document(page_content=_encoding.decode(tokens[start:start + CHUNK_TOKENS]), metadata=dict(doc.metadata))
+            for start in starts
+        ]))
+    return chunks
+
+def _dedupe_chunks(chunks: list[Document]) -> list[Document]:
+    """
+    Drops chunks whose text (ignoring whitespace) already appeared earlier in the same source,
+    e.g. repeated headers, footers or slides, so they aren't embedded and stored twice.
+    Chunks are only compared within one source: per-source deletes and document chat filter
+    on contentId, so a source must keep its own copy of every chunk.
+    """
+    seen: set[bytes] = set()
+    unique = []
+    for chunk in chunks:
+        digest = hashlib.blake2b(" ".join(chunk.page_content.split()).encode(), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(chunk)
+    return unique
+
+async def _process_one_file(
+    file: UploadFile,
+    tmp_path: str,
+    checksum: str,
+    size: int,
+    already_stored: bool,
+    cid: ObjectId,
+    user_id: ObjectId
+) -> tuple[dict, Document] | None:
+    """
+    Stores and converts a single upload. Returns the new content document with its full text
+    as a Document (split and embedded later, together with the rest of the batch), or None if
+    the file could not be converted. `already_stored` means another source already saved this checksum.
+    """
+    file_details = ALLOWED_MIME_TYPES[file.content_type]
+    file_suffix = file_details["suffix"]
+
+    async def _store():
+        if already_stored:
+            # The referencing source may be deleted while this file converts
+            await storage_service.cancel_file_deletion(checksum, file_suffix)
+        else:
+            await cache.add_known_checksums(checksum)
+            await storage_service.save_file_from_path(
                 checksum=checksum,
                 suffix=file_suffix,
-                file_bytes=file_bytes
+                path=tmp_path
             )
 
-        file_format = file_details["format"]
-        tmp_path = ""
-        text_content = ""
+    # Both steps only read the spooled file, so the storage upload runs while the
+    # conversion pool extracts the text instead of before it.
+    stored, extracted = await asyncio.gather(
+        _store(),
+        _extract_text(tmp_path, file_details["format"]),
+        return_exceptions=True
+    )
+    if isinstance(stored, BaseException):
+        raise stored
+    if isinstance(extracted, BaseException):
+        print(f"Error processing file {file.filename}: {extracted}")
+        return None
+    text_content = extracted
+
+    char_count = len(text_content)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    content_doc = {
+        "userId": user_id, "collectionId": cid, "sourceType": "document",
+        "fileInfo": {
+            "filename": file.filename, "format": file_details["format"], 
+            "size": size, "location": f"blob/{checksum}",
+            "suffix": file_suffix
+        },
+        "checksum": checksum, "charCount": char_count, "uploadedAt": now
+    }
+    
+    insert_result = await contents_db.insert_one(content_doc)
+    content_id = insert_result.inserted_id
+    content_doc["_id"] = content_id
 
-        try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_suffix) as tmp:
-                tmp.write(file_bytes)
-                tmp_path = tmp.name
-
-            if file_format == "audio":
-                with open(tmp_path, "rb") as audio_file:
-                    transcription = openai_client.audio.transcriptions.create(
-                        file=audio_file,
-                        model="whisper-1" # Or your preferred model
-                    )
-                    text_content = transcription.text
-            else:
-                text_content = MarkItDown().convert(tmp_path).text_content
-
-        except Exception as e:
-            print(f"Error processing file {file.filename}: {e}")
-            if tmp_path and os.path.exists(tmp_path):
-                os.remove(tmp_path)
-            continue # Skip to the next file on error
-        finally:
-            if tmp_path and os.path.exists(tmp_path):
-                os.remove(tmp_path)
+    doc = Document(page_content=text_content, metadata={"contentId": str(content_id), "filename": file.filename})
+    return content_doc, doc
 
-        char_count = len(text_content)
-        now = datetime.datetime.now(datetime.timezone.utc)
-        content_doc = {
-            "userId": user_id, "collectionId": cid, "sourceType": "document",
-            "fileInfo": {
-                "filename": file.filename, "format": file_details["format"], 
-                "size": len(file_bytes), "location": f"blob/{checksum}",
-                "suffix": file_suffix
-            },
-            "checksum": checksum, "charCount": char_count, "uploadedAt": now
-        }
-        
-        insert_result = await contents_db.insert_one(content_doc)
-        content_id = insert_result.inserted_id
-        content_doc["_id"] = content_id
+async def _process_spooled_files(
+    cid: ObjectId,
+    files: list[UploadFile],
+    spooled: list[tuple[str, str, int]],
+    user_id: ObjectId,
+    vector_store: QdrantVectorStore
+) -> list[ContentOut]:
+    """Deduplicates, converts and indexes uploads already spooled to disk by _spool_upload."""
+    checksums = [checksum for _, checksum, _ in spooled]
+
+    # One query answers both duplicate questions for the whole batch: is the file already in
+    # this collection (skip it), and is it stored anywhere (skip the storage upload).
+    # Files never seen anywhere (the common case) can't be duplicates, so skip Mongo for them
+    existing = []
+    if await cache.any_checksum_known(checksums):
+        existing = await contents_db.find(
+            {"checksum": {"$in": list(set(checksums))}},
+            projection={"_id": 0, "checksum": 1, "collectionId": 1}
+        ).to_list()
+    stored_checksums = {doc["checksum"] for doc in existing}
+    skip_checksums = {doc["checksum"] for doc in existing if doc["collectionId"] == cid}
+
+    pending = []
+    for file, (tmp_path, checksum, size) in zip(files, spooled):
+        # Prevent adding the exact same file to the same collection twice, within the batch too
+        if checksum in skip_checksums:
+            continue
+        skip_checksums.add(checksum)
+        pending.append((file, tmp_path, checksum, size))
+
+    # Files are independent and each one is dominated by network waits (storage,
+    # transcription, embeddings), so process them concurrently up to a small bound.
+    gate = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def _gated(file: UploadFile, tmp_path: str, checksum: str, size: int) -> tuple[dict, Document] | None:
+        async with gate:
+            return await _process_one_file(file, tmp_path, checksum, size, checksum in stored_checksums, cid, user_id)
+
+    results = await asyncio.gather(*(_gated(*item) for item in pending), return_exceptions=True)
+
+    content_docs: list[dict] = []
+    source_docs: list[Document] = []
+    for (file, *_), result in zip(pending, results):
+        if isinstance(result, BaseException):
+            print(f"Error processing file {file.filename}: {result}")
+            continue
+        if result is not None:
+            content_doc, source_doc = result
+            content_docs.append(content_doc)
+            source_docs.append(source_doc)
+
+    if not content_docs:
+        return []
+
+    # One embeddings + upsert pass for the whole batch instead of one per file. Every chunk
+    # carries its contentId, so per-source deletes by metadata.contentId keep working.
+    try:
+        all_chunks = await asyncio.to_thread(_split_documents, source_docs)
+        await vector_store.aadd_documents(all_chunks, batch_size=EMBEDDING_BATCH_SIZE)
+    except Exception:
+        # Without vectors the sources would be unsearchable, so undo the whole batch, including
+        # the chunks of any embedding batches that were already upserted
+        await asyncio.gather(
+            *(
+                asyncio.to_thread(qdrant_client.delete, collection_name=str(cid), points_selector=_source_points(str(doc["_id"])))
+                for doc in content_docs
+            ),
+            return_exceptions=True
+        )
+        await contents_db.delete_many({"_id": {"$in": [doc["_id"] for doc in content_docs]}})
+        await storage_service.delete_files_if_unreferenced(
+            [(doc["checksum"], doc["fileInfo"]["suffix"]) for doc in content_docs]
+        )
+        raise
 
-        doc = Document(page_content=text_content, metadata={"contentId": str(content_id), "filename": file.filename})
-        chunks = TokenTextSplitter(model_name="text-embedding-3-large", chunk_size=800, chunk_overlap=100).split_documents([doc])
-        await vector_store.aadd_documents(chunks)
-        await collections_db.update_one({"_id": cid}, {"$inc": {"totalChars": char_count}})
+    # One update on the collection document for the whole batch, not one per file
+    total_chars = sum(doc["charCount"] for doc in content_docs)
+    await collections_db.update_one(
+        {"_id": cid},
+        {"$inc": {"totalChars": total_chars}, "$set": {"updatedAt": datetime.datetime.now(datetime.timezone.utc)}}
+    )
+    return [ContentOut(**doc) for doc in content_docs]
 
-        processed_docs.append(ContentOut(**content_doc))
+async def process_uploaded_files(
+    cid: ObjectId,
+    files: list[UploadFile],
+    user_id: ObjectId
+) -> list[ContentOut]:
+    vector_store = get_vector_store(str(cid))
 
-    return processed_docs
+    # Validate every file type up front so a bad file rejects the batch before anything is stored.
+    for file in files:
+        if file.content_type not in ALLOWED_MIME_TYPES:
+            # In a real scenario, you might want to report which files failed
+            # but for now we raise immediately.
+            raise HTTPException(status_code=400, detail=f"Invalid file type for '{file.filename}'.")
+
+    spooled = await asyncio.gather(
+        *(_spool_upload(file, ALLOWED_MIME_TYPES[file.content_type]["suffix"]) for file in files),
+        return_exceptions=True
+    )
+    try:
+        for result in spooled:
+            if isinstance(result, BaseException):
+                raise result
+        return await _process_spooled_files(cid, files, spooled, user_id, vector_store)
+    finally:
+        for result in spooled:
+            if not isinstance(result, BaseException):
+                os.remove(result[0])
 
 
 async def process_youtube_url(
-    collection_id: str,
+    cid: ObjectId,
     url: str,
     user_id: ObjectId
 ) -> ContentOut:
-    cid = ObjectId(collection_id)
+    collection_id = str(cid)  # The Qdrant collection name
     try:
-        markdown_result = MarkItDown().convert(url)
+        # Fetching and converting the transcript blocks, so keep it off the event loop
+        markdown_result = await asyncio.to_thread(_markitdown.convert, url)
         text_content = markdown_result.text_content
         filename = (markdown_result.title or "YouTube Transcript") + ".txt"
         
         text_bytes = text_content.encode('utf-8')
-        checksum = compute_checksum(text_bytes)
-
-        if await contents_db.find_one({"collectionId": cid, "checksum": checksum}):
-            raise HTTPException(status_code=409, detail="This YouTube video has already been added to the collection.")
-
-        if not await contents_db.find_one({"checksum": checksum}):
+        checksum = await asyncio.to_thread(compute_checksum, text_bytes)
+
+        # A checksum that was never stored can't be a duplicate, so skip both lookups
+        already_stored = False
+        if await cache.any_checksum_known([checksum]):
+            if await contents_db.find_one({"collectionId": cid, "checksum": checksum}):
+                raise HTTPException(status_code=409, detail="This YouTube video has already been added to the collection.")
+            already_stored = await contents_db.find_one({"checksum": checksum}) is not None
+
+        if already_stored:
+            await storage_service.cancel_file_deletion(checksum, ".txt")
+        else:
+            await cache.add_known_checksums(checksum)
             await storage_service.save_file(
                 checksum=checksum,
                 suffix=".txt",
@@ -149,104 +425,114 @@ async def process_youtube_url(
             "charCount": char_count, "checksum": checksum, "uploadedAt": now
         }
 
-        insert_result = await contents_db.insert_one(content_doc)
-        content_id = insert_result.inserted_id
+        # The id is generated here so the content insert and the Qdrant upsert can run concurrently
+        content_id = ObjectId()
         content_doc["_id"] = content_id
-
-        await collections_db.update_one({"_id": cid}, {"$inc": {"totalChars": char_count}})
-        
-        vector_store = QdrantVectorStore(client=qdrant_client, collection_name=collection_id, embedding=embeddings)
         doc = Document(page_content=text_content, metadata={"contentId": str(content_id), "filename": filename})
-        chunks = TokenTextSplitter(model_name="text-embedding-3-large", chunk_size=800, chunk_overlap=100).split_documents([doc])
-        await vector_store.aadd_documents(chunks)
-        
+        chunks = await asyncio.to_thread(_split_documents, [doc])
+
+        inserted, indexed = await asyncio.gather(
+            contents_db.insert_one(content_doc),
+            get_vector_store(collection_id).aadd_documents(chunks),
+            return_exceptions=True
+        )
+        failure = next((r for r in (inserted, indexed) if isinstance(r, BaseException)), None)
+        if failure:
+            # Undo whichever write landed so the source doesn't half-exist
+            await asyncio.gather(
+                contents_db.delete_one({"_id": content_id}),
+                asyncio.to_thread(qdrant_client.delete, collection_name=collection_id, points_selector=_source_points(str(content_id))),
+                return_exceptions=True
+            )
+            raise failure
+
+        # updatedAt keys the collection text cache, so it only changes once the chunks are
+        # in Qdrant; earlier, a generation call could cache partial text under it.
+        await collections_db.update_one({"_id": cid}, {"$inc": {"totalChars": char_count}, "$set": {"updatedAt": now}})
+
         return ContentOut(**content_doc)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Could not process YouTube URL. Error: {e}")
 
-async def rename_source_in_dbs(collection_id: str, source_id: str, new_name: str) -> dict:
-    cid = ObjectId(collection_id)
-    sid = ObjectId(source_id)
+async def rename_source_in_dbs(cid: ObjectId, sid: ObjectId, new_name: str, user_id: ObjectId) -> dict:
 
+    # The userId in the filter doubles as the ownership check
     updated_doc = await contents_db.find_one_and_update(
-        {"_id": sid, "collectionId": cid},
+        {"_id": sid, "collectionId": cid, "userId": user_id},
         {"$set": {"fileInfo.filename": new_name}},
-        return_document=True
+        return_document=ReturnDocument.AFTER
     )
     if not updated_doc:
-        raise HTTPException(status_code=404, detail="Source document not found in this collection.")
+        raise HTTPException(status_code=404, detail="Source not found or access denied.")
 
     try:
-        points, _ = qdrant_client.scroll(
-            collection_name=collection_id,
-            scroll_filter=models.Filter(must=[models.FieldCondition(key="metadata.contentId", match=models.MatchValue(value=source_id))]),
-            limit=10000,
-            with_payload=False, with_vectors=False,
+        # Qdrant applies the payload to every chunk matching the filter server-side,
+        # so no point ids travel to the client and large sources aren't capped.
+        # key="metadata" writes into the nested object instead of a literal "metadata.filename" key.
+        await asyncio.to_thread(
+            qdrant_client.set_payload,
+            collection_name=str(cid),
+            payload={"filename": new_name},
+            key="metadata",
+            points=_source_points(str(sid)),
+            wait=True,
         )
-        point_ids = [point.id for point in points]
-        if point_ids:
-            qdrant_client.set_payload(
-                collection_name=collection_id,
-                payload={"metadata.filename": new_name},
-                points=point_ids,
-                wait=True,
-            )
     except Exception as e:
         # Ideally, you'd implement a rollback for the DB change here.
         raise HTTPException(status_code=500, detail=f"Failed to update Qdrant index: {e}")
     
     return updated_doc
 
-async def delete_source_from_dbs(collection_id: str, source_id: str):
-    cid = ObjectId(collection_id)
-    sid = ObjectId(source_id)
+async def delete_source_from_dbs(cid: ObjectId, sid: ObjectId, user_id: ObjectId):
 
-    source_doc = await contents_db.find_one({"_id": sid, "collectionId": cid})
+    # Ownership check, read and delete in one round trip
+    source_doc = await contents_db.find_one_and_delete({"_id": sid, "collectionId": cid, "userId": user_id})
     if not source_doc:
-        raise HTTPException(status_code=404, detail="Source document not found.")
+        raise HTTPException(status_code=404, detail="Source not found or access denied.")
 
-    user_id = source_doc.get("userId")
     checksum = source_doc.get("checksum")
     file_info = source_doc.get("fileInfo", {})
     suffix = file_info.get("suffix")
+    if not (checksum and suffix):
+        print(f"WARN: Cannot perform storage cleanup for source {sid}. Missing checksum or suffix.")
 
-    delete_result = await contents_db.delete_one({"_id": sid})
-    if delete_result.deleted_count == 0:
-        # This case is unlikely if find_one succeeded, but good practice.
-        raise HTTPException(status_code=404, detail="Source document not found for deletion.")
-    
-    if checksum and suffix:
-        await storage_service.delete_file_if_unreferenced(checksum=checksum, suffix=suffix)
-    else:
-        print(f"WARN: Cannot perform storage cleanup for source {source_id}. Missing checksum or suffix.")
-        
-    chars_to_remove = source_doc.get("charCount", 0)
-    if chars_to_remove > 0:
-        await collections_db.update_one({"_id": cid}, {"$inc": {"totalChars": -chars_to_remove}})
+    async def _cleanup_storage():
+        if checksum and suffix:
+            await storage_service.delete_file_if_unreferenced(checksum=checksum, suffix=suffix)
 
-    try:
-        qdrant_client.delete(
-            collection_name=collection_id,
-            points_selector=models.FilterSelector(
-                filter=models.Filter(
-                    must=[models.FieldCondition(key="metadata.contentId", match=models.MatchValue(value=source_id))]
-                )
-            ),
-            wait=True,
-        )
-    except Exception as e:
-        # The primary record is gone, but log the Qdrant failure for manual cleanup.
-        print(f"WARN: Failed to delete points for source {source_id} from Qdrant collection {collection_id}: {e}")
-    
-    if user_id:
-        await document_analysis_db.delete_many({
+    # The content document is gone, so the remaining cleanup steps don't depend on each other.
+    # Qdrant only has to accept the delete (wait=False): nothing reads this source's points
+    # once its content document no longer exists.
+    chars_to_remove = source_doc.get("charCount", 0)
+    counted, storage_cleaned, points_deleted, analyses_deleted = await asyncio.gather(
+        collections_db.update_one(
+            {"_id": cid},
+            {"$inc": {"totalChars": -chars_to_remove, "docCount": -1}, "$set": {"updatedAt": datetime.datetime.now(datetime.timezone.utc)}}
+        ),
+        _cleanup_storage(),
+        asyncio.to_thread(
+            qdrant_client.delete,
+            collection_name=str(cid),
+            points_selector=_source_points(str(sid)),
+            wait=False,
+        ),
+        document_analysis_db.delete_many({
             "contentId": sid,
             "userId": user_id
-        })
+        }),
+        return_exceptions=True
+    )
+    if isinstance(storage_cleaned, Exception):
+        print(f"WARN: Storage cleanup failed for source {sid}: {storage_cleaned}")
+    if isinstance(points_deleted, Exception):
+        # The primary record is gone, but log the Qdrant failure for manual cleanup.
+        print(f"WARN: Failed to delete points for source {sid} from Qdrant collection {cid}: {points_deleted}")
+    for result in (counted, analyses_deleted):
+        if isinstance(result, BaseException):
+            raise result
 
-async def rename_collection(collection_id: str, new_name: str, user_id: ObjectId) -> dict:
+async def rename_collection(cid: ObjectId, new_name: str, user_id: ObjectId) -> dict:
     """Renames a collection in the database."""
-    cid = ObjectId(collection_id)
     now = datetime.datetime.now(datetime.timezone.utc)
     updated_doc = await collections_db.find_one_and_update(
         {"_id": cid, "userId": user_id},
@@ -257,39 +543,43 @@ async def rename_collection(collection_id: str, new_name: str, user_id: ObjectId
         raise HTTPException(status_code=404, detail="Collection not found or user does not have access.")
     return updated_doc
 
-async def delete_collection_and_dependents(collection_id: str, user_id: ObjectId):
+async def delete_collection_and_dependents(cid: ObjectId, user_id: ObjectId):
     """Deletes a collection and all its associated data from all databases."""
-    cid = ObjectId(collection_id)
 
     # 1. Verify the collection exists and belongs to the user
     collection_to_delete = await collections_db.find_one({"_id": cid, "userId": user_id})
     if not collection_to_delete:
         raise HTTPException(status_code=404, detail="Collection not found or user does not have access.")
 
-    # When deleting a whole collection, trigger cleanup for all its files
-    async for content_doc in contents_db.find({"collectionId": cid}):
-        checksum = content_doc.get("checksum")
-        file_info = content_doc.get("fileInfo", {})
-        suffix = file_info.get("suffix")
-        
-        # We must delete the doc *first* so the reference count is correct
-        await contents_db.delete_one({"_id": content_doc["_id"]})
-        
-        if checksum and suffix:
-            await storage_service.delete_file_if_unreferenced(checksum, suffix)
-
-    # 2. Delete all dependent documents from MongoDB
-    await contents_db.delete_many({"collectionId": cid})
-    await chats_db.delete_many({"collectionId": cid})
-    await reinforcement_db.delete_many({"collectionId": cid})
-
-    # 3. Delete the collection from Qdrant
-    try:
-        qdrant_client.delete_collection(collection_name=collection_id)
-    except Exception as e:
+    # 2. Note which stored files the collection references before its contents go
+    content_docs = await contents_db.find(
+        {"collectionId": cid}, projection={"_id": 0, "checksum": 1, "fileInfo.suffix": 1}
+    ).to_list()
+    stored_files = {
+        (doc["checksum"], doc["fileInfo"]["suffix"])
+        for doc in content_docs
+        if doc.get("checksum") and doc.get("fileInfo", {}).get("suffix")
+    }
+
+    # 3. Delete the dependent documents and the Qdrant collection; they are independent
+    results = await asyncio.gather(
+        contents_db.delete_many({"collectionId": cid}),
+        chats_db.delete_many({"collectionId": cid}),
+        reinforcement_db.delete_many({"collectionId": cid}),
+        asyncio.to_thread(qdrant_client.delete_collection, collection_name=str(cid)),
+        return_exceptions=True
+    )
+    mongo_errors = [r for r in results[:3] if isinstance(r, BaseException)]
+    if mongo_errors:
+        raise mongo_errors[0]
+    if isinstance(results[3], BaseException):
         # Log the error but proceed, as the primary data is being deleted.
         # The Qdrant collection is now orphaned and may need manual cleanup.
-        print(f"WARNING: Failed to delete Qdrant collection '{collection_id}'. Error: {e}")
+        print(f"WARNING: Failed to delete Qdrant collection '{cid}'. Error: {results[3]}")
+
+    # Queue the files for the storage collector, which deletes those nothing else references
+    await storage_service.delete_files_if_unreferenced(list(stored_files))
 
     # 4. Delete the main collection document from MongoDB
     await collections_db.delete_one({"_id": cid})
+    evict_collection(cid)
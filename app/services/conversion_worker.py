@@ -0,0 +1,12 @@
+from markitdown import MarkItDown
+
+# Runs inside the conversion pool's worker processes. Those are started with forkserver, so
+# they import only this module, not the app's database clients and threads.
+_markitdown: MarkItDown | None = None
+
+def convert_to_text(tmp_path: str) -> str:
+    """Converts a spooled upload to text, building this process's MarkItDown on first use."""
+    global _markitdown
+    if _markitdown is None:
+        _markitdown = MarkItDown()
+    return _markitdown.convert(tmp_path).text_content
@@ -1,6 +1,8 @@
+import asyncio
 import datetime
 import math
-import random
+from functools import lru_cache
+import tiktoken
 from bson import ObjectId
 from fastapi import HTTPException
 from langchain_openai import ChatOpenAI
@@ -15,6 +17,7 @@ from app.models import (
     TeachMeBackAnswerRequest, Question
 )
 from app.services.qdrant_service import get_full_text_from_collection
+from app import cache
 
 # Define structured LLMs once
 mindmap_llm = ChatOpenAI(model="gpt-4.1-mini").with_structured_output(MindMap)
@@ -24,25 +27,98 @@ flashcard_llm = ChatOpenAI(model="gpt-4.1-mini").with_structured_output(Flashcar
 question_gen_llm = ChatOpenAI(model="gpt-4o").with_structured_output(Question)
 evaluation_llm = ChatOpenAI(model="gpt-4o").with_structured_output(TeachMeBackEvaluation)
 
-async def create_mind_map(collection_id: str, user_id: ObjectId, regenerate: bool = False) -> dict:
-    cid = ObjectId(collection_id)
-
-    if regenerate:
-        await reinforcement_db.delete_one({"collectionId": cid, "userId": user_id, "type": "mindMap"})
-    else:
-        existing = await reinforcement_db.find_one({"collectionId": cid, "userId": user_id, "type": "mindMap"})
-        if existing:
-            return existing
+# updatedAt versions the full text (see _get_collection_text); totalChars sizes the item counts
+TEXT_VERSION_PROJECTION = {"totalChars": 1, "updatedAt": 1}
+
+# Texts over GENERATION_TOKEN_LIMIT tokens are generated from in overlapping windows
+# concurrently, then merged, instead of overflowing a single prompt.
+GENERATION_TOKEN_LIMIT = 120_000
+MAP_WINDOW_TOKENS = 100_000
+MAP_WINDOW_OVERLAP = 5_000
+
+async def _replace_singleton_item(new_doc: dict) -> dict:
+    """
+    Stores a one-per-user item (mindMap, teachMeBack), replacing the previous one in a single
+    write. The old item is only replaced once the new one exists, so a failed generation keeps it.
+    """
+    return await reinforcement_db.find_one_and_replace(
+        {"collectionId": new_doc["collectionId"], "userId": new_doc["userId"], "type": new_doc["type"]},
+        new_doc,
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
 
-    full_text = await get_full_text_from_collection(collection_id)
-    prompt = f"""Based on the following text, which is compiled from numerous overlapping document chunks, create a comprehensive mind map. It is critical that you first synthesize the information to understand the core concepts and relationships, **ignoring any repetitive text that results from the overlapping chunks**. Your goal is to build a logically structured mind map of the unique topics present. The mind map must start with one or more root nodes representing the main topics. Each root node should branch out hierarchically into sub-topics and key concepts.
+async def _get_collection_text(cid: ObjectId, collection_doc: dict) -> str:
+    """
+    Returns the collection's full text, reusing an earlier scroll while its content is unchanged.
+    Every source add (once its chunks are indexed) and delete sets updatedAt, which keys the cache.
+    """
+    updated_at = collection_doc.get("updatedAt") if collection_doc else None
+    if updated_at is None:
+        return await get_full_text_from_collection(str(cid))
+    key = f"{cid}:{updated_at.isoformat()}"
+    full_text = await cache.get_collection_text(key)
+    if full_text is None:
+        full_text = await get_full_text_from_collection(str(cid))
+        await cache.set_collection_text(key, full_text)
+    return full_text
+
+@lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
+    # Loaded on first use; the BPE file may have to be fetched on a cold start
+    return tiktoken.get_encoding("o200k_base")
+
+def _split_into_windows(full_text: str) -> list[str]:
+    """Blocking tokenization of a large text into overlapping context windows."""
+    encoding = _encoding()
+    tokens = encoding.encode(full_text, disallowed_special=())
+    if len(tokens) <= GENERATION_TOKEN_LIMIT:
+        return [full_text]
+    step = MAP_WINDOW_TOKENS - MAP_WINDOW_OVERLAP
+    return [encoding.decode(tokens[i:i + MAP_WINDOW_TOKENS]) for i in range(0, len(tokens) - MAP_WINDOW_OVERLAP, step)]
+
+async def _context_windows(full_text: str) -> list[str]:
+    """
+    Returns the text as one window if it fits a single generation prompt, otherwise as
+    overlapping MAP_WINDOW_TOKENS windows to generate from concurrently (map-reduce).
+    """
+    # A token is at least one character, so short texts skip tokenization entirely
+    if len(full_text) <= GENERATION_TOKEN_LIMIT:
+        return [full_text]
+    return await asyncio.to_thread(_split_into_windows, full_text)
+
+def _spread(total: int, parts: int) -> list[int]:
+    """Splits an item count across windows as evenly as possible."""
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+async def find_mind_map(cid: ObjectId, user_id: ObjectId) -> dict | None:
+    return await reinforcement_db.find_one({"collectionId": cid, "userId": user_id, "type": "mindMap"})
+
+async def create_mind_map(cid: ObjectId, user_id: ObjectId) -> dict:
+    """Generates a mind map for the collection, replacing the user's existing one if any."""
+    collection_doc = await collections_db.find_one({"_id": cid}, TEXT_VERSION_PROJECTION)
+    full_text = await _get_collection_text(cid, collection_doc)
+    windows = await _context_windows(full_text)
+
+    def build_prompt(text: str) -> str:
+        return f"""Based on the following text, which is compiled from numerous overlapping document chunks, create a comprehensive mind map. It is critical that you first synthesize the information to understand the core concepts and relationships, **ignoring any repetitive text that results from the overlapping chunks**. Your goal is to build a logically structured mind map of the unique topics present. The mind map must start with one or more root nodes representing the main topics. Each root node should branch out hierarchically into sub-topics and key concepts.
 
 Here is the raw, overlapping content:
 ---
-{full_text}
+{text}
 """
     try:
-        mindmap_data = await mindmap_llm.ainvoke(prompt)
+        partial_maps = await asyncio.gather(*(mindmap_llm.ainvoke(build_prompt(window)) for window in windows))
+        mindmap_data = partial_maps[0]
+        if len(partial_maps) > 1:
+            # Reduce step: the partial maps overlap, so let the model merge them into one
+            partials_json = "\n\n".join(partial.model_dump_json(include={"roots"}) for partial in partial_maps)
+            mindmap_data = await mindmap_llm.ainvoke(
+                f"""The following mind maps (JSON) were each built from one part of the same body of text. Merge them into a single comprehensive mind map: combine root topics and sub-topics that cover the same concept, drop duplicates, and keep the hierarchy logically structured.
+
+{partials_json}
+"""
+            )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate mind map from LLM: {e}")
     
@@ -56,21 +132,19 @@ Here is the raw, overlapping content:
         "createdAt": now,
         "difficulty": None
     }
-    
-    result = await reinforcement_db.insert_one(new_doc)
-    new_doc["_id"] = result.inserted_id
-    return new_doc
+    return await _replace_singleton_item(new_doc)
 
-async def create_mcq_set(collection_id: str, request: GenerationRequest, user_id: ObjectId) -> dict:
-    cid = ObjectId(collection_id)
-    collection_doc = await collections_db.find_one({"_id": cid}) # Assumes ownership already checked
-    full_text = await get_full_text_from_collection(collection_id)
+async def create_mcq_set(cid: ObjectId, request: GenerationRequest, user_id: ObjectId) -> dict:
+    collection_doc = await collections_db.find_one({"_id": cid}, TEXT_VERSION_PROJECTION) # Assumes ownership already checked
+    full_text = await _get_collection_text(cid, collection_doc)
     
     content_ceiling = collection_doc.get("totalChars", 0) // 2000
     num_to_generate = max(1, min(request.numberOfItems, content_ceiling))
+    windows = await _context_windows(full_text)
 
-    prompt = f"""
-Based on the following text, which is compiled from overlapping document chunks, generate a set of {num_to_generate} Multiple Choice Questions (MCQs).
+    def build_prompt(text: str, count: int) -> str:
+        return f"""
+Based on the following text, which is compiled from overlapping document chunks, generate a set of {count} Multiple Choice Questions (MCQs).
 **First, synthesize the information to understand the core concepts, ignoring any repetitive text from the chunking process.**
 
 The questions should be of **{request.difficulty}** difficulty.
@@ -85,10 +159,15 @@ For each MCQ, provide:
 
 Here is the raw, overlapping content:
 ---
-{full_text}
+{text}
 """
     try:
-        mcq_data = await mcq_llm.ainvoke(prompt)
+        # Each window contributes its share of the questions; the sets just concatenate
+        parts = await asyncio.gather(*(
+            mcq_llm.ainvoke(build_prompt(window, count))
+            for window, count in zip(windows, _spread(num_to_generate, len(windows))) if count
+        ))
+        mcq_data = MCQSet(mcqs=[mcq for part in parts for mcq in part.mcqs])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate MCQs from LLM: {e}")
 
@@ -102,22 +181,23 @@ Here is the raw, overlapping content:
     return new_doc
 
 
-async def create_quiz_set(collection_id: str, request: GenerationRequest, user_id: ObjectId) -> dict:
-    cid = ObjectId(collection_id)
-    collection_doc = await collections_db.find_one({"_id": cid})
-    full_text = await get_full_text_from_collection(collection_id)
+async def create_quiz_set(cid: ObjectId, request: GenerationRequest, user_id: ObjectId) -> dict:
+    collection_doc = await collections_db.find_one({"_id": cid}, TEXT_VERSION_PROJECTION)
+    full_text = await _get_collection_text(cid, collection_doc)
 
     content_ceiling = collection_doc.get("totalChars", 0) // 1800
     total_questions = max(3, min(request.numberOfItems, content_ceiling))
     num_mcq = math.ceil(total_questions * 0.4)
     num_tf = math.ceil(total_questions * 0.3)
     num_sa = total_questions - num_mcq - num_tf
+    windows = await _context_windows(full_text)
 
-    prompt = f"""
+    def build_prompt(text: str, num_mcq: int, num_tf: int, num_sa: int) -> str:
+        return f"""
 Based on the following text, which is compiled from overlapping document chunks, generate a varied quiz to test a user's knowledge.
 **First, synthesize the information to understand the core concepts, ignoring any repetitive text from the chunking process.**
 
-The quiz should have a total of {total_questions} questions and be of **{request.difficulty}** difficulty.
+The quiz should have a total of {num_mcq + num_tf + num_sa} questions and be of **{request.difficulty}** difficulty.
 The quiz must contain a mix of the following question types:
 - Exactly {num_mcq} Multiple Choice questions (with 4 options each).
 - Exactly {num_tf} True/False questions.
@@ -130,10 +210,16 @@ Difficulty Guide:
 
 Here is the raw, overlapping content:
 ---
-{full_text}
+{text}
 """
     try:
-        quiz_data = await quiz_llm.ainvoke(prompt)
+        # Each window gets its share of every question type, so the merged quiz keeps the mix
+        window_counts = zip(_spread(num_mcq, len(windows)), _spread(num_tf, len(windows)), _spread(num_sa, len(windows)))
+        parts = await asyncio.gather(*(
+            quiz_llm.ainvoke(build_prompt(window, *counts))
+            for window, counts in zip(windows, window_counts) if any(counts)
+        ))
+        quiz_data = QuizSet(questions=[question for part in parts for question in part.questions])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate quiz from LLM: {e}")
 
@@ -147,16 +233,17 @@ Here is the raw, overlapping content:
     return new_doc
 
 
-async def create_flashcard_set(collection_id: str, request: GenerationRequest, user_id: ObjectId) -> dict:
-    cid = ObjectId(collection_id)
-    collection_doc = await collections_db.find_one({"_id": cid})
-    full_text = await get_full_text_from_collection(collection_id)
+async def create_flashcard_set(cid: ObjectId, request: GenerationRequest, user_id: ObjectId) -> dict:
+    collection_doc = await collections_db.find_one({"_id": cid}, TEXT_VERSION_PROJECTION)
+    full_text = await _get_collection_text(cid, collection_doc)
 
     content_ceiling = collection_doc.get("totalChars", 0) // 1500
     num_to_generate = max(3, min(request.numberOfItems, content_ceiling))
+    windows = await _context_windows(full_text)
 
-    prompt = f"""
-Based on the text below, which is compiled from overlapping chunks, generate {num_to_generate} flashcards of **{request.difficulty}** difficulty.
+    def build_prompt(text: str, count: int) -> str:
+        return f"""
+Based on the text below, which is compiled from overlapping chunks, generate {count} flashcards of **{request.difficulty}** difficulty.
 First, synthesize the information to understand the core concepts, ignoring any repetitive text.
 
 For each flashcard:
@@ -170,10 +257,14 @@ Difficulty Guide:
 
 Text:
 ---
-{full_text}
+{text}
 """
     try:
-        flashcard_data = await flashcard_llm.ainvoke(prompt)
+        parts = await asyncio.gather(*(
+            flashcard_llm.ainvoke(build_prompt(window, count))
+            for window, count in zip(windows, _spread(num_to_generate, len(windows))) if count
+        ))
+        flashcard_data = FlashcardSet(flashcards=[card for part in parts for card in part.flashcards])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate flashcards from LLM: {e}")
 
@@ -187,19 +278,25 @@ Text:
     return new_doc
 
 
-async def create_teach_me_back_question(collection_id: str, request: TeachMeBackQuestionRequest, user_id: ObjectId) -> dict:
-    cid = ObjectId(collection_id)
-    await reinforcement_db.delete_one({"collectionId": cid, "userId": user_id, "type": "teachMeBack"})
-
-    points, _ = qdrant_client.scroll(collection_name=collection_id, limit=100, with_payload=False, with_vectors=True)
-    if not points:
+async def create_teach_me_back_question(cid: ObjectId, request: TeachMeBackQuestionRequest, user_id: ObjectId) -> dict:
+    # Let Qdrant pick the seed chunk (random sampling, Qdrant >= 1.11) so only one vector is
+    # transferred instead of a page of them. The sync client runs in a worker thread.
+    sample = await asyncio.to_thread(
+        qdrant_client.query_points,
+        collection_name=str(cid),
+        query=models.SampleQuery(sample=models.Sample.RANDOM),
+        limit=1, with_payload=False, with_vectors=True
+    )
+    if not sample.points:
         raise HTTPException(status_code=404, detail="Not enough content to generate a question.")
 
-    random_point = random.choice(points)
+    random_point = sample.points[0]
     if not random_point.vector:
         raise HTTPException(status_code=500, detail="A random vector could not be retrieved.")
 
-    hits = qdrant_client.search(collection_name=collection_id, query_vector=random_point.vector, limit=5, with_payload=True)
+    hits = await asyncio.to_thread(
+        qdrant_client.search, collection_name=str(cid), query_vector=random_point.vector, limit=5, with_payload=True
+    )
     context_str = "\n\n---\n\n".join([hit.payload.get("page_content", "") for hit in hits])
     if not context_str.strip():
         raise HTTPException(status_code=404, detail="Could not form a valid context from the cluster.")
@@ -229,13 +326,10 @@ Now, generate the question.
         "type": "teachMeBack", "sourceType": "collection", "collectionId": cid, "userId": user_id,
         "difficulty": request.difficulty, "data": tmb_data.model_dump(), "createdAt": now
     }
-    result = await reinforcement_db.insert_one(new_doc)
-    new_doc["_id"] = result.inserted_id
-    return new_doc
+    return await _replace_singleton_item(new_doc)
 
 
-async def evaluate_teach_me_back_answer(collection_id: str, request: TeachMeBackAnswerRequest, user_id: ObjectId) -> TeachMeBackEvaluation:
-    cid = ObjectId(collection_id)
+async def evaluate_teach_me_back_answer(cid: ObjectId, request: TeachMeBackAnswerRequest, user_id: ObjectId) -> TeachMeBackEvaluation:
     tmb_doc = await reinforcement_db.find_one({"collectionId": cid, "userId": user_id, "type": "teachMeBack"})
     if not tmb_doc:
         raise HTTPException(status_code=404, detail="No active 'Teach Me Back' question found to evaluate.")
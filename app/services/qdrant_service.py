@@ -1,26 +1,82 @@
+import asyncio
+from functools import lru_cache
+from bson import ObjectId
 from fastapi import HTTPException
-from app.database import qdrant_client
+from langchain_qdrant import QdrantVectorStore
+from qdrant_client import models
+
+from app.database import qdrant_client, embeddings, contents_db
+
+FULL_TEXT_SCROLL_LIMIT = 1024  # Points per scroll page when assembling a collection's full text
+
+def create_vector_collection(collection_id: str):
+    """
+    Creates the Qdrant collection backing a new Collection. Blocking; run it via asyncio.to_thread.
+    """
+    qdrant_client.create_collection(
+        collection_name=collection_id,
+        vectors_config=models.VectorParams(size=3072, distance=models.Distance.COSINE),
+        # int8 copies of the vectors stay in RAM for the search pass (4x smaller than float32);
+        # the originals are only used to rescore the shortlist
+        quantization_config=models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+        )
+    )
+    # Document chat filters every search by source; without a payload index Qdrant has to
+    # check that filter point by point instead of planning the search around it.
+    qdrant_client.create_payload_index(
+        collection_name=collection_id,
+        field_name="metadata.contentId",
+        field_schema=models.PayloadSchemaType.KEYWORD
+    )
+
+@lru_cache(maxsize=1024)
+def get_vector_store(collection_id: str) -> QdrantVectorStore:
+    """
+    Returns a shared vector store for a Qdrant collection. Called from async code, so the
+    constructor's blocking config check is skipped; create_vector_collection sets that config.
+    """
+    return QdrantVectorStore(
+        client=qdrant_client, collection_name=collection_id, embedding=embeddings,
+        validate_collection_config=False
+    )
+
+def _scroll_source_text(collection_id: str, content_id: str) -> list[str]:
+    """Collects the chunk texts of one source. Blocking; run it via asyncio.to_thread."""
+    source_filter = models.Filter(
+        must=[models.FieldCondition(key="metadata.contentId", match=models.MatchValue(value=content_id))]
+    )
+    texts = []
+    next_offset = None
+    while True:
+        points, next_offset = qdrant_client.scroll(
+            collection_name=collection_id,
+            scroll_filter=source_filter,
+            limit=FULL_TEXT_SCROLL_LIMIT,
+            with_payload=["page_content"],
+            offset=next_offset
+        )
+        texts.extend(point.payload["page_content"] for point in points if "page_content" in point.payload)
+        if not next_offset:
+            return texts
 
 async def get_full_text_from_collection(collection_id: str) -> str:
-    """Fetches and concatenates all text chunks from a Qdrant collection."""
-    all_chunks_content = []
+    """
+    Fetches and concatenates all text chunks from a Qdrant collection. Point ids are UUIDs, so
+    the scroll is split by source (through the metadata.contentId index) rather than by offset,
+    and the per-source scrolls run concurrently.
+    """
+    content_ids = await contents_db.distinct("_id", {"collectionId": ObjectId(collection_id)})
     try:
-        next_offset = None
-        while True:
-            points, next_offset = qdrant_client.scroll(
-                collection_name=collection_id,
-                limit=256, with_payload=True, offset=next_offset
-            )
-            for point in points:
-                if 'page_content' in point.payload:
-                    all_chunks_content.append(point.payload['page_content'])
-            if not next_offset:
-                break
+        per_source = await asyncio.gather(
+            *(asyncio.to_thread(_scroll_source_text, collection_id, str(content_id)) for content_id in content_ids)
+        )
     except Exception as e:
         # This can happen if the collection doesn't exist in Qdrant.
         raise HTTPException(status_code=404, detail=f"Could not retrieve content from vector store: {e}")
 
-    if not all_chunks_content:
+    full_text = "\n\n".join(text for texts in per_source for text in texts)
+    if not full_text:
         raise HTTPException(status_code=404, detail="No text content found in this collection.")
     
-    return "\n\n".join(all_chunks_content)
+    return full_text
@@ -1,86 +1,382 @@
 import os
+import shutil
+import asyncio
+import tempfile
+import datetime
+from typing import AsyncIterator, BinaryIO
+from cachetools import LRUCache
 from azure.storage.blob.aio import BlobServiceClient
 from azure.core.exceptions import ResourceNotFoundError
 from fastapi import HTTPException
+from pymongo import UpdateOne
 
-from app.database import contents_db
+from app.database import contents_db, pending_file_deletions_db
+from app.log import get_logger
+from app.utils import storage_name
+
+logger = get_logger(__name__)
+
+# What save_file accepts: an in-memory buffer, or a binary file object that is streamed
+FileData = bytes | bytearray | memoryview | BinaryIO
 
 # ─── Environment Configuration ────────────────────────────────────────────────
 AZURE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 AZURE_CONTAINER_NAME = os.getenv("AZURE_CONTAINER_NAME")
 LOCAL_STORAGE_PATH = os.getenv("LOCAL_STORAGE_PATH", "local_storage")
+LOCAL_STORAGE_FSYNC = os.getenv("LOCAL_STORAGE_FSYNC") == "1"  # Flush local writes to disk before they count as saved
+LOCAL_FILE_MODE = 0o644  # Temp files are created 0600; stored files get the usual file permissions
+STREAM_CHUNK_SIZE = 1 << 20  # 1 MiB
+# Blobs larger than one block are uploaded and downloaded as parallel block/range requests
+AZURE_BLOCK_SIZE = 4 << 20  # 4 MiB
+AZURE_MAX_CONCURRENCY = 8
+FILE_CACHE_MAX_BYTES = 64 << 20  # Total size of the in-process get_file_bytes cache
+FILE_CACHE_MAX_ITEM_BYTES = 4 << 20  # Larger files are always read from storage
+GC_INTERVAL_SECONDS = 60  # How often the collector looks for queued deletions
+GC_GRACE_SECONDS = 15 * 60  # Minimum time a queued file is kept, so in-flight uploads can still claim it
+GC_BATCH_SIZE = 256  # Files per collector pass; also the most blobs one Azure batch delete accepts
 
 # ─── Client Initialization ────────────────────────────────────────────────────
 blob_service_client = None
+container_client = None
 storage_mode = "local"
 
 if AZURE_CONNECTION_STRING and AZURE_CONTAINER_NAME:
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(AZURE_CONNECTION_STRING)
+        blob_service_client = BlobServiceClient.from_connection_string(
+            AZURE_CONNECTION_STRING,
+            max_single_put_size=AZURE_BLOCK_SIZE,
+            max_block_size=AZURE_BLOCK_SIZE,
+            max_single_get_size=AZURE_BLOCK_SIZE,
+            max_chunk_get_size=AZURE_BLOCK_SIZE
+        )
+        # The container never changes, so build its client (and request pipeline) once
+        container_client = blob_service_client.get_container_client(AZURE_CONTAINER_NAME)
         storage_mode = "azure"
-        print("✅ Storage Service: Connected to Azure Blob Storage.")
+        logger.info("✅ Storage Service: Connected to Azure Blob Storage.")
     except Exception as e:
-        print(f"❌ Storage Service: Failed to connect to Azure. Falling back to local. Error: {e}")
+        logger.error("❌ Storage Service: Failed to connect to Azure. Falling back to local. Error: %s", e)
         storage_mode = "local"
 else:
-    print(f"⚠️  Storage Service: Azure credentials not set. Using local storage at '{LOCAL_STORAGE_PATH}'.")
+    logger.warning("⚠️  Storage Service: Azure credentials not set. Using local storage at '%s'.", LOCAL_STORAGE_PATH)
 
 if storage_mode == "local":
     os.makedirs(LOCAL_STORAGE_PATH, exist_ok=True)
 
+# Files are named by their content checksum, so a cached copy can never go stale.
+_file_cache: LRUCache[str, bytes] = LRUCache(maxsize=FILE_CACHE_MAX_BYTES, getsizeof=len)
+
+# Where uploads are spooled before they are stored. For local storage that is the storage
+# directory itself, so save_file_from_path can hard-link the spooled file instead of copying it.
+SPOOL_DIR = LOCAL_STORAGE_PATH if storage_mode == "local" else None
+
+
+# ─── Azure Backend ────────────────────────────────────────────────────────────
+# Files are named by the SHA-256 of their content, so a file that already exists holds
+# exactly these bytes. The save functions skip the write then and return False.
+# Passing the length up front lets the SDK plan single-put vs. block upload and stream the
+# data as-is, instead of measuring (or, for file objects, buffering) it first.
+def _data_length(data: FileData) -> int | None:
+    if isinstance(data, memoryview):
+        return data.nbytes
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    try:
+        return os.fstat(data.fileno()).st_size - data.tell()
+    except (AttributeError, OSError, ValueError):
+        return None  # Not backed by a real file, so the SDK has to find out itself
+
+async def _azure_save(storage_filename: str, file_bytes: FileData) -> bool:
+    blob_client = container_client.get_blob_client(storage_filename)
+    if await blob_client.exists():
+        return False
+    await blob_client.upload_blob(
+        file_bytes, length=_data_length(file_bytes), overwrite=True, max_concurrency=AZURE_MAX_CONCURRENCY
+    )
+    return True
+
+async def _azure_save_from_path(storage_filename: str, path: str) -> bool:
+    blob_client = container_client.get_blob_client(storage_filename)
+    if await blob_client.exists():
+        return False
+    with open(path, "rb") as f:
+        await blob_client.upload_blob(
+            f, length=os.fstat(f.fileno()).st_size, overwrite=True, max_concurrency=AZURE_MAX_CONCURRENCY
+        )
+    return True
+
+async def _azure_delete_many(storage_filenames: list[str]):
+    # One batch request for the whole list; missing blobs come back as 404 and are skipped
+    try:
+        responses = await container_client.delete_blobs(
+            *storage_filenames, delete_snapshots="include", raise_on_any_failure=False
+        )
+        # Sub-responses come back in request order
+        names = iter(storage_filenames)
+        async for response in responses:
+            name = next(names)
+            if response.status_code == 404:
+                logger.warning("Blob '%s' not found in Azure container '%s'. It may have been deleted already.", name, AZURE_CONTAINER_NAME)
+            elif response.status_code >= 300:
+                logger.error("Failed to delete blob '%s' from Azure. Status: %s", name, response.status_code)
+    except Exception as e:
+        logger.error("Failed to delete %d blob(s) from Azure. Error: %s", len(storage_filenames), e)
+
+async def _azure_read(storage_filename: str) -> bytes:
+    blob_client = container_client.get_blob_client(storage_filename)
+    downloader = await blob_client.download_blob(max_concurrency=AZURE_MAX_CONCURRENCY)
+    return await downloader.readall()
+
+async def _azure_open(storage_filename: str) -> tuple[AsyncIterator[bytes], int]:
+    blob_client = container_client.get_blob_client(storage_filename)
+    downloader = await blob_client.download_blob()
+    return downloader.chunks(), downloader.size
+
+# ─── Local Backend ────────────────────────────────────────────────────────────
+# Files are sharded by the first two bytes of their checksum (ab/cd/abcd….pdf), so each leaf
+# directory holds about 1/65536 of the stored files instead of one directory holding all of
+# them. Files saved before the sharding sit directly in LOCAL_STORAGE_PATH; reads and
+# deletes fall back to that path.
+def _local_path(storage_filename: str) -> str:
+    return os.path.join(LOCAL_STORAGE_PATH, storage_filename[:2], storage_filename[2:4], storage_filename)
 
-async def save_file(checksum: str, suffix: str, file_bytes: bytes) -> str:
+def _flat_path(storage_filename: str) -> str:
+    return os.path.join(LOCAL_STORAGE_PATH, storage_filename)
+
+def _write_all(fd: int, data: bytes | bytearray | memoryview):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _write_file(path: str, data: FileData) -> bool:
+    """
+    Blocking local write; run it in a worker thread. Returns False if the file already existed.
+    The data goes straight to a temp file with os.write (no buffered writer in between), which
+    then replaces the final name, so readers never see a partially written file. Buffers are
+    written through a memoryview without copying; file objects are copied in chunks.
+    """
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=LOCAL_STORAGE_PATH, suffix=".tmp")
+    try:
+        try:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                _write_all(fd, data)
+            else:
+                while chunk := data.read(STREAM_CHUNK_SIZE):
+                    _write_all(fd, chunk)
+            if LOCAL_STORAGE_FSYNC:
+                os.fsync(fd)
+            os.fchmod(fd, LOCAL_FILE_MODE)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return True
+
+def _open_stored_file(storage_filename: str) -> BinaryIO:
+    """Blocking open of a stored file, falling back to the pre-sharding flat layout."""
+    try:
+        return open(_local_path(storage_filename), "rb")
+    except FileNotFoundError:
+        return open(_flat_path(storage_filename), "rb")
+
+def _read_stored_file(storage_filename: str) -> bytes:
+    """Blocking local read; run it in a worker thread."""
+    with _open_stored_file(storage_filename) as f:
+        return f.read()
+
+def _remove_file(path: str) -> bool:
+    """Blocking local delete; returns False if the file was already gone."""
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _link_or_copy(src: str, dst: str) -> bool:
+    """
+    Hard-links src into local storage, which costs no data copy when both are on the same
+    filesystem (see SPOOL_DIR), and falls back to copying the file.
+    Returns False if the file already existed.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    # A link shares the spooled temp file's inode, so fix its mode before linking
+    os.chmod(src, LOCAL_FILE_MODE)
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        return False
+    except OSError:
+        if os.path.exists(dst):
+            return False
+        # Copy under a temp name first, like _write_file, so dst only ever appears complete
+        fd, tmp_path = tempfile.mkstemp(dir=LOCAL_STORAGE_PATH, suffix=".tmp")
+        try:
+            os.fchmod(fd, LOCAL_FILE_MODE)
+        finally:
+            os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, dst)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return True
+
+async def _iter_local_file(f: BinaryIO) -> AsyncIterator[bytes]:
+    """Yields a local file in STREAM_CHUNK_SIZE pieces, reading off the event loop, then closes it."""
+    try:
+        while chunk := await asyncio.to_thread(f.read, STREAM_CHUNK_SIZE):
+            yield chunk
+    finally:
+        f.close()
+
+async def _local_save(storage_filename: str, file_bytes: FileData) -> bool:
+    return await asyncio.to_thread(_write_file, _local_path(storage_filename), file_bytes)
+
+async def _local_save_from_path(storage_filename: str, path: str) -> bool:
+    return await asyncio.to_thread(_link_or_copy, path, _local_path(storage_filename))
+
+def _remove_files(storage_filenames: list[str]):
+    """Blocking local delete of a batch of stored files; run it in a worker thread."""
+    for storage_filename in storage_filenames:
+        # Remove both layouts: a file stored before the sharding may since have been saved again
+        removed = _remove_file(_local_path(storage_filename))
+        if not _remove_file(_flat_path(storage_filename)) and not removed:
+            logger.warning("File '%s' not found in local storage. It may have been deleted already.", storage_filename)
+
+async def _local_delete_many(storage_filenames: list[str]):
+    await asyncio.to_thread(_remove_files, storage_filenames)
+
+async def _local_read(storage_filename: str) -> bytes:
+    return await asyncio.to_thread(_read_stored_file, storage_filename)
+
+async def _local_open(storage_filename: str) -> tuple[AsyncIterator[bytes], int]:
+    f = await asyncio.to_thread(_open_stored_file, storage_filename)
+    return _iter_local_file(f), os.fstat(f.fileno()).st_size
+
+# The storage mode is fixed at import, so bind the backend once instead of branching per call
+if storage_mode == "azure":
+    _save, _save_from_path, _delete_many, _read, _open = (
+        _azure_save, _azure_save_from_path, _azure_delete_many, _azure_read, _azure_open
+    )
+else:
+    _save, _save_from_path, _delete_many, _read, _open = (
+        _local_save, _local_save_from_path, _local_delete_many, _local_read, _local_open
+    )
+
+
+# ─── Public API ───────────────────────────────────────────────────────────────
+def _log_save(storage_filename: str, written: bool):
+    if written:
+        logger.info("Saved file '%s' to %s storage.", storage_filename, storage_mode)
+    else:
+        logger.info("dedup hit, '%s' is already in %s storage.", storage_filename, storage_mode)
+
+async def save_file(checksum: str, suffix: str, file_bytes: FileData) -> str:
     """
     Saves a file to the configured storage (Azure or Local) using its checksum as the name.
+    file_bytes may be a buffer or a binary file object; neither is copied into a new bytes object.
     Returns the name of the stored file.
     """
     if not suffix:
         raise HTTPException(status_code=500, detail="Cannot save file without a file extension suffix.")
-        
-    storage_filename = f"{checksum}{suffix}"
 
-    if storage_mode == "azure":
-        container_client = blob_service_client.get_container_client(AZURE_CONTAINER_NAME)
-        blob_client = container_client.get_blob_client(storage_filename)
-        await blob_client.upload_blob(file_bytes, overwrite=True)
-    else:  # local
-        file_path = os.path.join(LOCAL_STORAGE_PATH, storage_filename)
-        with open(file_path, "wb") as f:
-            f.write(file_bytes)
-            
-    print(f"INFO: Saved file '{storage_filename}' to {storage_mode} storage.")
+    storage_filename = storage_name(checksum, suffix)
+    await _cancel_deletion(storage_filename)
+    _log_save(storage_filename, await _save(storage_filename, file_bytes))
     return storage_filename
 
+async def save_file_from_path(checksum: str, suffix: str, path: str) -> str:
+    """
+    Like save_file, but streams the content from a file on disk instead of holding it in memory.
+    Returns the name of the stored file.
+    """
+    if not suffix:
+        raise HTTPException(status_code=500, detail="Cannot save file without a file extension suffix.")
 
-async def delete_file_if_unreferenced(checksum: str, suffix: str):
+    storage_filename = storage_name(checksum, suffix)
+    await _cancel_deletion(storage_filename)
+    _log_save(storage_filename, await _save_from_path(storage_filename, path))
+    return storage_filename
+
+
+async def _cancel_deletion(storage_filename: str):
+    # A queued file may still be on disk (a dedup hit), but the Content document that will
+    # reference it is only inserted after conversion, which can outlast the grace period.
+    # Dropping the entry first keeps the collector from deleting the file in that window.
+    await pending_file_deletions_db.delete_one({"_id": storage_filename})
+
+async def cancel_file_deletion(checksum: str, suffix: str):
+    """Takes a stored file off the deletion queue because a new source is about to reuse it."""
+    await _cancel_deletion(storage_name(checksum, suffix))
+
+async def delete_files_if_unreferenced(files: list[tuple[str, str]]):
     """
-    Deletes a file from storage if no other MongoDB documents reference its checksum.
+    Queues stored files, given as (checksum, suffix) pairs, for deletion. Nothing is deleted
+    here: the collector (run_storage_collector) removes each file once it has been queued for
+    GC_GRACE_SECONDS and no Content document references its checksum any more.
     """
-    # Check if any other document in the database references this checksum.
-    # This is called *after* the primary document has been deleted.
-    if await contents_db.count_documents({"checksum": checksum}) > 0:
-        print(f"INFO: Checksum '{checksum}' is still referenced. File will not be deleted.")
+    if not files:
         return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Re-queuing a file restarts its grace period
+    await pending_file_deletions_db.bulk_write(
+        [
+            UpdateOne({"_id": storage_name(checksum, suffix)}, {"$set": {"checksum": checksum, "queuedAt": now}}, upsert=True)
+            for checksum, suffix in files
+        ],
+        ordered=False
+    )
+
+async def delete_file_if_unreferenced(checksum: str, suffix: str):
+    """Queues one stored file for deletion; see delete_files_if_unreferenced."""
+    await delete_files_if_unreferenced([(checksum, suffix)])
+
+async def collect_unreferenced_files() -> int:
+    """
+    Deletes one batch of queued files whose grace period is over and whose checksum no
+    Content document references. Returns the number of queue entries processed.
+    """
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=GC_GRACE_SECONDS)
+    batch = await pending_file_deletions_db.find(
+        {"queuedAt": {"$lte": cutoff}}, projection={"checksum": 1}
+    ).limit(GC_BATCH_SIZE).to_list()
+    if not batch:
+        return 0
+
+    # Re-check the references now, in one query for the whole batch
+    referenced = set(await contents_db.distinct("checksum", {"checksum": {"$in": [doc["checksum"] for doc in batch]}}))
+    unreferenced = [doc["_id"] for doc in batch if doc["checksum"] not in referenced]
+    if unreferenced:
+        # A save since the batch was read cancelled its entry; only delete files still queued
+        unreferenced = await pending_file_deletions_db.distinct(
+            "_id", {"_id": {"$in": unreferenced}, "queuedAt": {"$lte": cutoff}}
+        )
+    if unreferenced:
+        for storage_filename in unreferenced:
+            _file_cache.pop(storage_filename, None)
+        logger.info("Deleting %d unreferenced file(s) from %s storage.", len(unreferenced), storage_mode)
+        await _delete_many(unreferenced)
 
-    # No references found, proceed with deletion from storage
-    storage_filename = f"{checksum}{suffix}"
-    print(f"INFO: Checksum '{checksum}' is no longer referenced. Deleting '{storage_filename}'.")
+    # Entries re-queued meanwhile have a newer queuedAt and stay for the next pass
+    await pending_file_deletions_db.delete_many(
+        {"_id": {"$in": [doc["_id"] for doc in batch]}, "queuedAt": {"$lte": cutoff}}
+    )
+    return len(batch)
 
-    if storage_mode == "azure":
+async def run_storage_collector():
+    """Every GC_INTERVAL_SECONDS, deletes queued files until the due part of the queue is empty."""
+    while True:
+        await asyncio.sleep(GC_INTERVAL_SECONDS)
         try:
-            container_client = blob_service_client.get_container_client(AZURE_CONTAINER_NAME)
-            blob_client = container_client.get_blob_client(storage_filename)
-            await blob_client.delete_blob(delete_snapshots="include")
-        except ResourceNotFoundError:
-            print(f"WARN: Blob '{storage_filename}' not found in Azure container '{AZURE_CONTAINER_NAME}'. It may have been deleted already.")
+            while await collect_unreferenced_files() == GC_BATCH_SIZE:
+                pass
         except Exception as e:
-            print(f"ERROR: Failed to delete blob '{storage_filename}' from Azure. Error: {e}")
-    else:  # local
-        file_path = os.path.join(LOCAL_STORAGE_PATH, storage_filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        else:
-            print(f"WARN: File '{file_path}' not found in local storage. It may have been deleted already.")
+            logger.error("Storage collection failed: %s", e)
 
 async def get_file_bytes(checksum: str, suffix: str) -> bytes:
     """
@@ -90,22 +386,38 @@ async def get_file_bytes(checksum: str, suffix: str) -> bytes:
     if not suffix:
         raise ValueError("Cannot retrieve file without a suffix.")
 
-    storage_filename = f"{checksum}{suffix}"
+    storage_filename = storage_name(checksum, suffix)
+    cached = _file_cache.get(storage_filename)
+    if cached is not None:
+        return cached
 
     try:
-        if storage_mode == "azure":
-            container_client = blob_service_client.get_container_client(AZURE_CONTAINER_NAME)
-            blob_client = container_client.get_blob_client(storage_filename)
-            downloader = await blob_client.download_blob()
-            return await downloader.readall()
-        else: # local
-            file_path = os.path.join(LOCAL_STORAGE_PATH, storage_filename)
-            with open(file_path, "rb") as f:
-                return f.read()
-    except ResourceNotFoundError:
+        data = await _read(storage_filename)
+    except (ResourceNotFoundError, FileNotFoundError):
         raise HTTPException(status_code=404, detail=f"File '{storage_filename}' not found in {storage_mode} storage.")
-    except FileNotFoundError:
+    except Exception as e:
+        logger.error("Could not read file '%s'. Error: %s", storage_filename, e)
+        raise HTTPException(status_code=500, detail="Could not read source file from storage.")
+
+    if len(data) <= FILE_CACHE_MAX_ITEM_BYTES:
+        _file_cache[storage_filename] = data
+    return data
+
+async def open_file_stream(checksum: str, suffix: str) -> tuple[AsyncIterator[bytes], int]:
+    """
+    Opens a file from the configured storage (Azure or Local) for streaming.
+    Returns (chunk iterator, size in bytes). Missing files raise before anything
+    is sent, so callers can still answer with a proper 404.
+    """
+    if not suffix:
+        raise ValueError("Cannot retrieve file without a suffix.")
+
+    storage_filename = storage_name(checksum, suffix)
+
+    try:
+        return await _open(storage_filename)
+    except (ResourceNotFoundError, FileNotFoundError):
         raise HTTPException(status_code=404, detail=f"File '{storage_filename}' not found in {storage_mode} storage.")
     except Exception as e:
-        print(f"ERROR: Could not read file '{storage_filename}'. Error: {e}")
+        logger.error("Could not open file '%s'. Error: %s", storage_filename, e)
         raise HTTPException(status_code=500, detail="Could not read source file from storage.")
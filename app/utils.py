@@ -1,10 +1,112 @@
 import hashlib
+from typing import Any, BinaryIO
+
+import numpy as np
+import orjson
+from bson import ObjectId
+from cachetools import TTLCache
+from fastapi import Request
+from fastapi.responses import ORJSONResponse
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+def compute_checksum(data: bytes | BinaryIO) -> str:
+    """
+    Computes the SHA256 checksum of a byte string or of a binary file opened for reading.
+    Files are hashed incrementally with hashlib.file_digest, so they are never read into memory whole.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(data).hexdigest()
+    return hashlib.file_digest(data, "sha256").hexdigest()
 
-def compute_checksum(file_bytes: bytes) -> str:
-    """Computes the SHA256 checksum of a byte string."""
-    return hashlib.sha256(file_bytes).hexdigest()
+def storage_name(checksum: str, suffix: str) -> str:
+    """The name a file is stored under: its content checksum plus its extension."""
+    return checksum + suffix
 
 def format_docs(docs: list[Document]) -> str:
     """Helper function to format retrieved documents into a single string."""
-    return "\n\n".join(doc.page_content for doc in docs)
+    return "\n\n".join([doc.page_content for doc in docs])
+
+def make_etag(data: bytes) -> str:
+    """Builds a weak ETag from the bytes that define a response's representation."""
+    return f'W/"{hashlib.blake2b(data, digest_size=16).hexdigest()}"'
+
+def document_etag(doc: dict) -> str:
+    """ETag for a stored document that is replaced or touched (updatedAt) whenever it changes."""
+    version = doc.get("updatedAt") or doc.get("createdAt")
+    return make_etag(f"{doc['_id']}:{version}".encode())
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Returns True if the request's If-None-Match already names this ETag."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip() for tag in header.split(","))
+
+def _orjson_default(obj: Any) -> Any:
+    """Fallback encoder for types orjson does not handle natively."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def format_sse(data: Any, event: str | None = None) -> str:
+    """Formats a payload as a single Server-Sent Events message."""
+    payload = orjson.dumps(data, default=_orjson_default).decode()
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+class MongoORJSONResponse(ORJSONResponse):
+    """ORJSONResponse that also serializes BSON ObjectIds as hex strings."""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model with an LRU + TTL cache for query embeddings, so repeated
+    chat queries don't pay for another API call. Cached vectors are stored as int8 with a
+    per-vector scale (4x smaller than float32); document embeddings pass straight through.
+    """
+    def __init__(self, inner: Embeddings, maxsize: int = 10_000, ttl: int = 6 * 60 * 60):
+        self.inner = inner
+        self._cache: TTLCache[bytes, tuple[float, np.ndarray]] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _store(self, key: bytes, vector: list[float]):
+        v = np.asarray(vector, dtype=np.float32)
+        scale = float(np.abs(v).max()) / 127 or 1.0
+        self._cache[key] = (scale, np.round(v / scale).astype(np.int8))
+
+    def _load(self, key: bytes) -> list[float] | None:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        scale, quantized = entry
+        return (quantized.astype(np.float32) * scale).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.inner.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.inner.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        cached = self._load(key)
+        if cached is not None:
+            return cached
+        vector = self.inner.embed_query(text)
+        self._store(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        cached = self._load(key)
+        if cached is not None:
+            return cached
+        vector = await self.inner.aembed_query(text)
+        self._store(key, vector)
+        return vector
@@ -443,25 +443,55 @@ const ChatView: FC<ChatViewProps> = ({ collectionName, sources, onAddSourceClick
         const userMessage: ChatMessageData = { role: 'user', content: input, timestamp: new Date().toISOString() };
         setMessages(prev => [...prev, userMessage]);
         setInput('');
+        let isStreaming = false;
         try {
             const response = await fetch(`${API_BASE_URL}/collections/${collectionId}/chat`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ query: input }),
             });
-            if (!response.ok) {
+            if (!response.ok || !response.body) {
                 const errorData = await response.json();
                 throw new Error(errorData.detail || "Failed to get a response.");
             }
-            const assistantMessage = await response.json();
-            setMessages(prev => [...prev, assistantMessage]);
+
+            // The reply arrives as Server-Sent Events: token deltas, then a final "done" message.
+            const updateAssistant = (patch: Partial<ChatMessageData>) =>
+                setMessages(prev => [...prev.slice(0, -1), { ...prev[prev.length - 1], ...patch }]);
+            setMessages(prev => [...prev, { role: 'assistant', content: '', timestamp: new Date().toISOString() }]);
+            isStreaming = true;
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let content = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\n\n');
+                buffer = events.pop() ?? '';
+                for (const rawEvent of events) {
+                    const lines = rawEvent.split('\n');
+                    const event = lines.find(l => l.startsWith('event: '))?.slice(7) ?? 'message';
+                    const data = JSON.parse(lines.find(l => l.startsWith('data: '))?.slice(6) ?? '{}');
+                    if (event === 'error') throw new Error(data.detail || "Failed to get a response.");
+                    if (event === 'done') {
+                        updateAssistant(data);
+                    } else {
+                        content += data.delta;
+                        updateAssistant({ content });
+                    }
+                }
+            }
         } catch (err) {
-            const errorMessage: ChatMessageData = { 
-                role: 'assistant', 
-                content: `Sorry, an error occurred: ${err instanceof Error ? err.message : ''}`, 
+            const errorMessage: ChatMessageData = {
+                role: 'assistant',
+                content: `Sorry, an error occurred: ${err instanceof Error ? err.message : ''}`,
                 timestamp: new Date().toISOString()
             };
-            setMessages(prev => [...prev, errorMessage]);
+            // Replace the partially streamed reply, if any, with the error
+            setMessages(prev => isStreaming ? [...prev.slice(0, -1), errorMessage] : [...prev, errorMessage]);
         } finally {
             setIsSending(false);
         }
@@ -0,0 +1,43 @@
+"""
+Gunicorn configuration for running the API with Uvicorn workers.
+
+    gunicorn app.main:app -c gunicorn_conf.py
+
+UvicornWorker picks uvloop and httptools automatically when they are installed.
+"""
+import os
+import asyncio
+import multiprocessing
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ─── Server ───────────────────────────────────────────────────────────────────
+bind = os.getenv("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = 5
+timeout = 120  # LLM-backed endpoints can take a while to respond
+
+# The in-process document-chat cache only works with a single worker, so only
+# scale out when sessions are shared through Redis.
+_default_workers = 2 * multiprocessing.cpu_count() if os.getenv("REDIS_URL") else 1
+workers = int(os.getenv("WEB_CONCURRENCY", _default_workers))
+
+
+# ─── Hooks ────────────────────────────────────────────────────────────────────
+def on_starting(server):
+    """Runs the database migrations once in the master, before any worker is forked."""
+    from pymongo import AsyncMongoClient
+    from app.migrations import run_migrations
+
+    async def _migrate():
+        client = AsyncMongoClient(os.getenv("MONGO_ENDPOINT"))
+        try:
+            await run_migrations(client.get_default_database())
+        finally:
+            await client.close()
+
+    asyncio.run(_migrate())
+    # Workers inherit the master's environment, so their lifespan skips the check.
+    os.environ["SKIP_MIGRATIONS"] = "1"